@@ -55,6 +55,10 @@ N_ITER = 10
 
 WINDOW_SIZE = 224
 
+IO_THREADS = 4
+PENDING_PATCHES = 64
+POLL_INTERVAL = 0.1
+
 CAFFE_BATCH_SIZE = 10
 
 
@@ -26,25 +26,45 @@ Patch extraction
 
 Extract patches from an image
 
+Patches can also be extracted from many images at once, given
+in a list file or a directory. Images are processed by a pool
+of processes (see --cores), and the patches of each image are
+encoded and written by a pool of I/O threads, so that PNG
+encoding and writes overlap, also with the decoding of the
+next image. An image is only reported done once all its
+patches are written. Images lost with a worker (e.g., killed
+for lack of memory) are reported as failures.
+
 """
 
 
 import sys
 import os
+import time
 import argparse
-from multiprocessing import cpu_count
+from functools import partial
+from threading import Thread, BoundedSemaphore
+from Queue import Queue
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+from multiprocessing.util import Finalize
 from skimage.util import view_as_windows
 from matplotlib.pyplot import imread, imsave
 
-from common import WINDOW_SIZE, dir_type, file_type, print_verbose, set_verbose_level, get_n_cores, set_n_cores
+from common import WINDOW_SIZE, IO_THREADS, PENDING_PATCHES, POLL_INTERVAL, dir_type, file_type, print_verbose, set_verbose_level, get_n_cores, set_n_cores
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('-i', '--image', type=file_type, required=True,
+    parser.add_argument('-i', '--image', type=file_type,
                         help='input image')
+    parser.add_argument('-l', '--list', type=file_type,
+                        help='file containing list of images to process')
+    parser.add_argument('-I', '--input', type=dir_type,
+                        help='input images directory (all images, or those in --list)')
     parser.add_argument('-d', '--dir', type=dir_type, required=True,
                         help='destination directory')
     parser.add_argument('-w', '--window', default=WINDOW_SIZE, type=int,
@@ -53,17 +73,25 @@ def parse_args(argv):
                         help='step size (default: %d)' % WINDOW_SIZE)
     parser.add_argument('-c', '--cores', default=get_n_cores(), type=int,
                         choices=xrange(1, cpu_count()+1),
-                        help='number of cores to be used (default: %d) -- currently not used' % get_n_cores())
+                        help='number of cores to be used (default: %d)' % get_n_cores())
+    parser.add_argument('-t', '--io-threads', default=IO_THREADS, type=int,
+                        help='number of threads writing patches of each image (default: %d)' % IO_THREADS)
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='verbosity level')
 
     args = parser.parse_args(args=argv)
+    if args.image is None and args.list is None and args.input is None:
+        parser.error('one of --image, --list or --input is required')
     return args
 
 
-def save_img(im, path):
-    print_verbose("Saving patch %s ..." % path, 3)
-    imsave(path, im)
+def save_img(im, path, slots=None):
+    try:
+        print_verbose("Saving patch %s ..." % path, 3)
+        imsave(path, im)
+    finally:
+        if slots is not None:
+            slots.release()
 
 
 def gen_patch_path(im_path, dest_dir, id):
@@ -78,7 +106,8 @@ def gen_patch_path(im_path, dest_dir, id):
     return dest_path
 
 
-def patch_extract(im_path, window_size, step_size, dest_dir):
+def patch_extract(im_path, window_size, step_size, dest_dir, io_pool=None,
+                  writes=None, slots=None):
 
     # Read image
     im = imread(im_path)
@@ -100,6 +129,7 @@ def patch_extract(im_path, window_size, step_size, dest_dir):
     print_verbose("View shape: %s" % str(view.shape), 5)
 
     id = 0
+    pending = [] if writes is None else writes
     for i in range(view.shape[0]):
         for j in range(view.shape[1]):
 
@@ -112,9 +142,135 @@ def patch_extract(im_path, window_size, step_size, dest_dir):
             print_verbose("Current view shape: %s" % str(tmp_view.shape), 5)
 
             # Save patch
-            save_img(tmp_view, dest_path)
+            if io_pool is None:
+                save_img(tmp_view, dest_path)
+            else:
+                if slots is not None:
+                    slots.acquire()
+                pending.append(io_pool.apply_async(save_img, (tmp_view, dest_path, slots)))
             id += 1
 
+    # Wait for patches to be written, unless left to the caller
+    if writes is None:
+        for w in pending:
+            w.get()
+
+    return id
+
+
+def list_images(im_list=None, im_dir=None):
+    if im_list is not None:
+        with open(im_list) as f:
+            names = [name for name in f.read().splitlines() if name]
+        if im_dir is not None:
+            names = [os.path.join(im_dir, name) for name in names]
+        return names
+
+    return [os.path.join(im_dir, fn) for fn in sorted(os.listdir(im_dir))
+            if not fn.startswith('.') and os.path.isfile(os.path.join(im_dir, fn))]
+
+
+def report_writes(images, reports):
+    for im_path, n_patches, writes, error in iter(images.get, None):
+        for w in writes:
+            try:
+                w.get()
+            except Exception as e:
+                error = error or str(e)
+        reports.put((im_path, n_patches, error))
+
+
+def flush_writes():
+    io_images.put(None)
+    io_reporter.join()
+    io_pool.close()
+    io_pool.join()
+
+
+def init_worker(io_threads, started, reports):
+    global io_pool, io_slots, io_images, io_reporter, io_started
+    io_started = started
+    io_pool = ThreadPool(processes=io_threads)
+    io_slots = BoundedSemaphore(PENDING_PATCHES)
+    io_images = Queue()
+    io_reporter = Thread(target=report_writes, args=(io_images, reports))
+    io_reporter.daemon = True
+    io_reporter.start()
+    # Before the I/O pool is terminated (at priority 15)
+    Finalize(None, flush_writes, exitpriority=20)
+
+
+def extract_image(window_size, step_size, dest_dir, im_path):
+    io_started.put((im_path, os.getpid()))
+    writes = []
+    try:
+        n_patches = patch_extract(im_path, window_size, step_size, dest_dir, io_pool,
+                                  writes, io_slots)
+        io_images.put((im_path, n_patches, writes, None))
+    except Exception as e:
+        io_images.put((im_path, 0, writes, str(e)))
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def batch_extract(im_paths, window_size, step_size, dest_dir, io_threads=IO_THREADS):
+    started = SimpleQueue()
+    reports = SimpleQueue()
+    pool = Pool(processes=get_n_cores(), initializer=init_worker,
+                initargs=(io_threads, started, reports))
+    fn = partial(extract_image, window_size, step_size, dest_dir)
+
+    # Images are reported once their patches are written
+    pool.map_async(fn, im_paths, chunksize=1)
+    pool.close()
+
+    running = {}
+    done = set()
+    lost = False
+    failures = 0
+    while len(done) < len(im_paths):
+        if reports.empty() and started.empty():
+            time.sleep(POLL_INTERVAL)
+
+            # Images of dead workers, whose reports will never come
+            for im_path, pid in running.items():
+                if not is_alive(pid):
+                    del running[im_path]
+                    done.add(im_path)
+                    lost = True
+                    failures += 1
+                    sys.stderr.write("Could not extract patches from %s: lost worker\n" % im_path)
+            continue
+
+        while not started.empty():
+            im_path, pid = started.get()
+            if im_path not in done:
+                running[im_path] = pid
+
+        while not reports.empty():
+            im_path, n_patches, error = reports.get()
+            running.pop(im_path, None)
+            done.add(im_path)
+            if error is not None:
+                failures += 1
+                sys.stderr.write("Could not extract patches from %s: %s\n" % (im_path, error))
+            else:
+                print_verbose("Extracted %d patches from %s [%d/%d]" % (n_patches, im_path,
+                    len(done), len(im_paths)), 1)
+
+    # Tasks lost with a worker are never completed, so the pool cannot be joined
+    if lost:
+        pool.terminate()
+    pool.join()
+
+    return failures
+
 
 def main(argv):
 
@@ -126,7 +282,18 @@ def main(argv):
     print_verbose("Args: %s" % str(args), 1)
 
     # Extract patches
-    patch_extract(args.image, args.window, args.step, args.dir)
+    if args.image is not None:
+        io_pool = ThreadPool(processes=args.io_threads)
+        patch_extract(args.image, args.window, args.step, args.dir, io_pool)
+        io_pool.close()
+        io_pool.join()
+        return
+
+    im_paths = list_images(args.list, args.input)
+    print_verbose("Extracting patches from %d images" % len(im_paths), 0)
+    failures = batch_extract(im_paths, args.window, args.step, args.dir, args.io_threads)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+# bench_crawl.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Benchmark crawl
+============================================================
+
+Benchmark the crawl and download stages
+
+A local stand-in server (see standin_server.py) is started,
+unless another API is given, and then the crawl stage
+(crawl2csv) and the download stage (download_images_from_csv)
+are run against it. Each stage runs in its own process, and
+reports its throughput and peak memory.
+
+By default, a single synthetic category is crawled, so
+results are repeatable. Latency, bandwidth and error rate
+are passed on to the stand-in server.
+
+"""
+
+
+import sys
+import os
+import argparse
+import time
+import shutil
+import tempfile
+import resource
+import traceback
+from multiprocessing import Process, Queue
+from standin_server import StandinServer, DEFAULT_CORPUS
+from crawler import crawl_many
+from crawl2csv import extract_data, gen_csv
+from download_images_from_csv import download_from_csv
+from common import set_verbose_level, set_api_url, print_verbose, \
+        dir_type, DEFAULT_THREADS
+
+
+DEFAULT_PAGES = 200
+DEFAULT_IMAGE_SIZE = 256 * 1024           # bytes
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-u', '--url', type=str, nargs='+',
+            help='page urls (default: a synthetic category)')
+    parser.add_argument('-n', '--pages', type=int, default=DEFAULT_PAGES,
+            help='number of pages of the synthetic category (default: %d)' % DEFAULT_PAGES)
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS,
+            help='number of concurrent requests and downloads (default: %d)' % DEFAULT_THREADS)
+    parser.add_argument('--two-phase', action='store_true',
+            help='list pages first, then fetch them in concurrent batches')
+    parser.add_argument('--no-download', action='store_true',
+            help='skip the download stage')
+    parser.add_argument('--api', type=str,
+            help='api url (default: start a local stand-in server)')
+    parser.add_argument('-r', '--recorded', type=dir_type,
+            help='api cache directory with recorded responses for the stand-in server')
+    parser.add_argument('-s', '--image-size', type=int, default=DEFAULT_IMAGE_SIZE,
+            help='size of synthetic images in bytes (default: %d)' % DEFAULT_IMAGE_SIZE)
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+            help='latency of each request in seconds (default: 0)')
+    parser.add_argument('-b', '--bandwidth', type=float, default=0.0,
+            help='bandwidth of each connection in bytes/s (default: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+            help='fraction of requests that fail (default: 0)')
+    parser.add_argument('--max-active', type=int, default=0,
+            help='throttle image requests beyond this many at once (default: unlimited)')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+# Peak memory of the current process, in MB
+def peak_memory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Crawl stage
+def crawl_stage(url_list, csv_path, threads, two_phase):
+    result = crawl_many(url_list, threads, None, two_phase)
+
+    raw_data = extract_data(result)
+    raw_data.sort()
+    with open(csv_path, 'wb') as csvfile:
+        gen_csv(csvfile, raw_data)
+
+    return len(raw_data), os.path.getsize(csv_path)
+
+
+# Download stage
+#   The progress bar is silenced, as it would clutter the output
+def download_stage(csv_path, dest_dir, threads):
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stderr.fileno())
+    with open(csv_path, 'rb') as csvfile:
+        download_from_csv(csvfile, dest_dir, threads=threads)
+
+    files = [fname for fname in os.listdir(dest_dir) if not fname.startswith('.')]
+    return len(files), sum(os.path.getsize(os.path.join(dest_dir, fname))
+            for fname in files)
+
+
+# Run a stage in a child process
+#   Returns a tuple (items, bytes, seconds, peak memory in MB)
+def run_stage(queue, api_url, verbose, fn, *args):
+    set_api_url(api_url)
+    set_verbose_level(verbose)
+    stderr = os.fdopen(os.dup(sys.stderr.fileno()), 'w')
+    try:
+        start = time.time()
+        items, nbytes = fn(*args)
+        queue.put((items, nbytes, time.time() - start, peak_memory()))
+    except Exception:
+        traceback.print_exc(file=stderr)
+        queue.put(None)
+
+
+def bench_stage(name, api_url, verbose, fn, *args):
+    queue = Queue()
+    proc = Process(target=run_stage, args=(queue, api_url, verbose, fn) + args)
+    proc.start()
+    stats = queue.get()
+    proc.join()
+
+    if stats is None:
+        print_verbose("%-9s failed" % name, 0)
+        return None
+
+    items, nbytes, seconds, memory = stats
+    print_verbose("%-9s %6d items %10.1f items/s %8.2f MB/s %8.1f MB peak" % (name,
+        items, items / seconds, nbytes / seconds / 2**20, memory), 0)
+    return stats
+
+
+# Serve stand-in in a child process
+def serve(server):
+    set_verbose_level(-1)
+    server.serve_forever()
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    # Stand-in server
+    server = None
+    api_url = args.api
+    if api_url is None:
+        server = StandinServer(('127.0.0.1', 0), DEFAULT_CORPUS, args.recorded,
+                args.pages, args.image_size, args.latency, args.bandwidth,
+                args.error_rate, args.max_active)
+        api_url = server.base_url + '/w/api.php'
+        server_proc = Process(target=serve, args=(server,))
+        server_proc.daemon = True
+        server_proc.start()
+        print_verbose("Stand-in server at %s" % api_url, 1)
+
+    url_list = args.url or ['Category:Synthetic_1_%d' % args.pages]
+    work_dir = tempfile.mkdtemp(prefix='bench_crawl.')
+    csv_path = os.path.join(work_dir, 'crawl.csv')
+    img_dir = os.path.join(work_dir, 'img')
+    os.mkdir(img_dir)
+
+    # Run stages
+    try:
+        stats = bench_stage('Crawl', api_url, args.verbose - 1, crawl_stage,
+                url_list, csv_path, args.threads, args.two_phase)
+
+        if stats is not None and not args.no_download:
+            bench_stage('Download', api_url, args.verbose - 1, download_stage,
+                    csv_path, img_dir, args.threads)
+    finally:
+        shutil.rmtree(work_dir)
+        if server is not None:
+            server_proc.terminate()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+# bench_extract.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Benchmark extraction
+============================================================
+
+Benchmark metadata extraction from page contents
+
+The single-pass extractor from crawl2csv is compared with
+the reference regular expressions, both in throughput and
+in output. Page contents are read from a corpus file, or
+from the pages of the responses in an API cache directory,
+which may also be recorded into a new corpus file.
+
+The default corpus (corpus/synthetic_wikitext.json) is made
+of synthetic pages, written by hand after the templates found
+on Commons and their edge cases. Benchmarks on real pages
+should use a corpus recorded from a crawl cache instead.
+
+"""
+
+
+import sys
+import os
+import argparse
+import json
+import gzip
+import time
+from re import search
+from cache import ResponseCache
+from crawl2csv import extract_image_content, extract_data
+from common import set_verbose_level, print_verbose, dir_type, \
+        PARALLEL_EXTRACT_MIN
+
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'corpus', 'synthetic_wikitext.json')
+DEFAULT_REPEAT = 100
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-c', '--corpus', type=str, default=DEFAULT_CORPUS,
+            help='corpus file (default: %s)' % DEFAULT_CORPUS)
+    parser.add_argument('--cache', type=dir_type,
+            help='read corpus from api cache directory instead')
+    parser.add_argument('--record', type=argparse.FileType('w'),
+            help='save corpus read from cache to file')
+    parser.add_argument('-n', '--repeat', type=int, default=DEFAULT_REPEAT,
+            help='number of passes over the corpus (default: %d)' % DEFAULT_REPEAT)
+    parser.add_argument('--cores', type=int, default=1,
+            help='also benchmark extraction of a large result with this many cores')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+# Reference extractor (regular expressions used up to now)
+def extract_image_content_regex(content):
+
+    # Avoid errors
+    content = content.encode('ascii', errors='backslashreplace')
+
+    # Paint ID
+    m = search(r"(?i)(?:^|\|)\s?(?:id|references|accession number|notes)\s*=\s*\[*{*(?P<id>[{\w].*?)}*\]*(?:\n(?:\s*\||\*)|$)",
+            content)
+    paint_id = m.group('id') if m is not None else None
+
+    # Artist
+    m = search(r"(?i)(?:^|\|)\s?(?:commons_)?(?:artist|author)\s*=\s*{*(?:creator:)?(?P<artist>.*?)}*\s*(?:\n\s*\||$)",
+            content)
+    artist = m.group('artist') if m is not None else None
+
+    # Dimensions
+    m = search(r"(?i)(?:^|\|)\s?(?:pretty_)?dimensions\s*=\s*{*(?P<dim>.*?)}*(?:\n\s*\||$)",
+            content)
+    dim = m.group('dim') if m is not None else None
+
+    return (paint_id, artist, dim)
+
+
+# Read corpus file
+def read_corpus(corpus_path):
+    with open(corpus_path, 'r') as f:
+        return json.load(f)
+
+
+# Read corpus from cached responses
+def read_cache_corpus(cache_dir):
+    corpus = {}
+    cache = ResponseCache(cache_dir, offline=True)
+    for path in cache.list_entries():
+        with gzip.open(path, 'rb') as f:
+            result = json.load(f)
+
+        for page in result.get('query', {}).get('pages', {}).values():
+            try:
+                corpus[page['pageid']] = {'pageid': page['pageid'],
+                        'title': page['title'],
+                        'content': page['revisions'][0]['*']}
+            except (KeyError, IndexError):
+                pass
+
+    return [corpus[page_id] for page_id in sorted(corpus)]
+
+
+# Time a given extractor over the corpus
+def bench(fn, contents, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        for content in contents:
+            fn(content)
+    return time.time() - start
+
+
+# Compare outputs of both extractors
+def compare(corpus):
+    mismatches = 0
+    for page in corpus:
+        expected = extract_image_content_regex(page['content'])
+        actual = extract_image_content(page['content'])
+        if expected != actual:
+            mismatches += 1
+            sys.stderr.write("Mismatch on PageID %s (%s)\n" % (page['pageid'],
+                page['title'].encode('ascii', errors='backslashreplace')))
+            sys.stderr.write("-- expected %s\n" % str(expected))
+            sys.stderr.write("-- actual   %s\n" % str(actual))
+    return mismatches
+
+
+# Time extraction of a large synthetic result
+def bench_extract_data(corpus, cores):
+
+    n_pages = max(PARALLEL_EXTRACT_MIN, 10 * len(corpus))
+    result = {}
+    for i in xrange(n_pages):
+        page = corpus[i % len(corpus)]
+        result[str(i)] = {'pageid': i,
+                'imageinfo': [{'descriptionurl': '', 'url': '', 'sha1': '',
+                    'height': 1, 'width': 1}],
+                'revisions': [{'revid': i, '*': page['content']}]}
+
+    start = time.time()
+    extract_data(result, cores)
+    return n_pages, time.time() - start
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    # Read corpus
+    if args.cache is not None:
+        corpus = read_cache_corpus(args.cache)
+        if args.record is not None:
+            json.dump(corpus, args.record, indent=1, sort_keys=True)
+    else:
+        corpus = read_corpus(args.corpus)
+
+    if not corpus:
+        sys.stderr.write("Empty corpus\n")
+        return
+
+    contents = [page['content'] for page in corpus]
+    total_bytes = sum(len(content) for content in contents)
+    print_verbose("Corpus: %d pages, %d characters" % (len(contents), total_bytes), 0)
+
+    # Output
+    mismatches = compare(corpus)
+    print_verbose("Mismatches: %d" % mismatches, 0)
+
+    # Throughput
+    n_pages = len(contents) * args.repeat
+    t_regex = bench(extract_image_content_regex, contents, args.repeat)
+    t_single = bench(extract_image_content, contents, args.repeat)
+
+    print_verbose("Reference:   %10.1f pages/s" % (n_pages / t_regex), 0)
+    print_verbose("Single-pass: %10.1f pages/s" % (n_pages / t_single), 0)
+    print_verbose("Speedup:     %10.2fx" % (t_regex / t_single), 0)
+
+    # Multiprocess extraction
+    if args.cores > 1:
+        n_pages, t_serial = bench_extract_data(corpus, 1)
+        n_pages, t_parallel = bench_extract_data(corpus, args.cores)
+        print_verbose("Extract %d pages, 1 core:   %10.1f pages/s" % (n_pages, n_pages / t_serial), 0)
+        print_verbose("Extract %d pages, %d cores: %10.1f pages/s" % (n_pages, args.cores, n_pages / t_parallel), 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# cache.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Cache
+============================================================
+
+On-disk cache for API responses
+
+Responses are stored compressed, keyed by the SHA1 digest
+of the query parameters (which include continuation values).
+Entries expire after a given TTL, and the least recently
+used entries are evicted when the cache exceeds its size,
+down to a fraction of it, so that evictions are infrequent.
+In offline mode, expired entries are still served, and
+misses are errors instead of network requests.
+
+"""
+
+
+import os
+import time
+import json
+import gzip
+import hashlib
+import threading
+from common import print_verbose, \
+        DEFAULT_CACHE_TTL, DEFAULT_CACHE_SIZE
+
+
+CACHE_EXT = '.json.gz'
+
+# Fraction of the maximum size left after evicting
+CACHE_LOW_WATER = 0.9
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    def __init__(self, cache_dir, ttl=DEFAULT_CACHE_TTL,
+            max_size=DEFAULT_CACHE_SIZE, offline=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.size = sum(os.path.getsize(path) for path in self.list_entries())
+        print_verbose("Cache %s: %d bytes" % (cache_dir, self.size), 2)
+
+    # Key for a given query
+    #   Values are taken as strings, as they are sent
+    def key(self, params):
+        params = dict((k, v if isinstance(v, basestring) else str(v))
+                for k, v in params.items())
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_EXT)
+
+    def list_entries(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for fname in files:
+                if fname.endswith(CACHE_EXT):
+                    yield os.path.join(root, fname)
+
+    # Get cached response, or None
+    def get(self, params):
+        path = self.path(self.key(params))
+
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age > self.ttl and not self.offline:
+                print_verbose("Cache expired: %s" % path, 3)
+                return None
+
+            with gzip.open(path, 'rb') as f:
+                result = json.load(f)
+        except (OSError, IOError, ValueError):
+            if self.offline:
+                raise CacheMiss("Query not in cache: %s" % str(params))
+            return None
+
+        # Mark as recently used, unless evicted in the meantime
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
+
+        print_verbose("Cache hit: %s" % path, 3)
+        return result
+
+    # Store response
+    def put(self, params, result):
+        path = self.path(self.key(params))
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+
+        with gzip.open(tmp_path, 'wb') as f:
+            json.dump(result, f)
+
+        with self.lock:
+            if os.path.isfile(path):
+                self.size -= os.path.getsize(path)
+            os.rename(tmp_path, path)
+            self.size += os.path.getsize(path)
+
+            if self.size > self.max_size:
+                self.evict()
+
+    # Remove least recently used entries until under the low-water mark
+    #   Entries removed in the meantime (by another process) are skipped
+    def evict(self):
+        entries = []
+        for path in self.list_entries():
+            try:
+                entries.append((os.path.getatime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        self.size = sum(fsize for atime, fsize, path in entries)
+
+        for atime, fsize, path in entries:
+            if self.size <= self.max_size * CACHE_LOW_WATER:
+                break
+            print_verbose("Cache evict: %s" % path, 3)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= fsize
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+
+# catalog.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Catalog
+============================================================
+
+Convert a CSV file to a compact columnar catalog
+
+A catalog is a directory with one binary (numpy) file per
+column, which are memory mapped when opened, so only the
+columns actually used are read. Integer and float columns
+are stored as such (when written exactly as read back),
+hexadecimal digests (e.g., SHA1) as binary, columns with few
+distinct values as codes, other fixed-length strings as
+fixed-width arrays, and other strings as a single buffer
+with offsets, without their common prefix. PageID and
+ImageSHA1 have sorted indices for fast lookups.
+
+All crawler stages accept either a CSV file or a catalog,
+and read only the columns they need.
+
+"""
+
+
+import sys
+import os
+import argparse
+import csv
+import json
+import re
+from binascii import hexlify, unhexlify
+from itertools import imap, izip
+import numpy as np
+from contextlib import contextmanager
+from common import set_verbose_level, print_verbose
+
+
+CATALOG_FIELDS = 'fields.json'
+INDEXED_FIELDS = ['PageID', 'ImageSHA1']
+
+# Columns with up to this many distinct values are stored as codes
+MAX_CATEGORIES = 256
+
+HEX_REGEX = re.compile('^([0-9a-f]{2})+$')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-c', '--csv', type=argparse.FileType('r'), required=True,
+            help='csv file')
+    parser.add_argument('-o', '--catalog', type=str, required=True,
+            help='catalog directory')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+# Check whether a path is a catalog
+def is_catalog(path):
+    return os.path.isfile(os.path.join(str(path), CATALOG_FIELDS))
+
+
+# Argument type for either a CSV file or a catalog
+def table_type(x):
+    x = str(x)
+    if is_catalog(x):
+        return x
+    return argparse.FileType('r')(x)
+
+
+# Open either a CSV file or a catalog, for table_reader or table_columns
+@contextmanager
+def open_table(path):
+    if is_catalog(path):
+        yield path
+    else:
+        with open(path, 'rb') as f:
+            yield f
+
+
+# Reader for either a CSV file or a catalog
+#   As with csv.reader, the first row holds the field names
+def table_reader(source):
+    if isinstance(source, basestring) and is_catalog(source):
+        return catalog_reader(Catalog(source))
+    return csv.reader(source, quoting=csv.QUOTE_ALL, strict=True)
+
+
+def catalog_reader(catalog):
+    yield catalog.field_names
+    for row in catalog.rows():
+        yield row
+
+
+# Columns of either a CSV file or a catalog, as lists of strings
+#   Only the given columns are read from a catalog
+def table_columns(source, names):
+    if isinstance(source, basestring) and is_catalog(source):
+        catalog = Catalog(source)
+        return [catalog.strings(name) for name in names]
+
+    reader = csv.reader(source, quoting=csv.QUOTE_ALL, strict=True)
+    field_names = reader.next()
+    idx = [field_names.index(name) for name in names]
+    columns = [[] for name in names]
+    for row in reader:
+        for column, i in zip(columns, idx):
+            column.append(row[i])
+    return columns
+
+
+# Guess column type from its values
+#   Numbers must be written exactly as they would be read back
+def column_type(values):
+    try:
+        if all(str(int(value)) == value for value in values):
+            return 'int'
+    except ValueError:
+        pass
+
+    try:
+        if all(repr(float(value)) == value for value in values):
+            return 'float'
+    except ValueError:
+        pass
+
+    if len(values) > 0 and len(set(len(value) for value in values)) == 1:
+        if all(HEX_REGEX.match(value) for value in values):
+            return 'hex'
+        return 'fixed'
+    if len(set(values)) <= MAX_CATEGORIES:
+        return 'category'
+    return 'str'
+
+
+# Smallest integer type for the given range
+def int_dtype(low, high):
+    if np.iinfo(np.int32).min <= low and high <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+# Longest common prefix of strings
+def common_prefix(values):
+    return os.path.commonprefix(values) if values else ''
+
+
+# UTF-8 strings from JSON values
+def utf8(value):
+    if isinstance(value, list):
+        return [utf8(item) for item in value]
+    return value.encode('utf-8')
+
+
+# Column file path
+def column_path(cat_dir, name, suffix=''):
+    return os.path.join(cat_dir, name + suffix + '.npy')
+
+
+# Write catalog from field names and rows (lists of strings)
+def write_catalog(cat_dir, field_names, rows):
+
+    if not os.path.isdir(cat_dir):
+        os.makedirs(cat_dir)
+
+    columns = zip(*rows) if rows else [()] * len(field_names)
+    types = {}
+    extra = {}
+
+    for name, values in zip(field_names, columns):
+        ctype = column_type(values)
+        types[name] = ctype
+        print_verbose("Column %s: %s" % (name, ctype), 2)
+
+        if ctype == 'int':
+            data = np.array([int(value) for value in values], dtype=np.int64)
+            if len(data) > 0:
+                data = data.astype(int_dtype(data.min(), data.max()))
+        elif ctype == 'float':
+            data = np.array(values, dtype=np.float64)
+        elif ctype == 'hex':
+            data = np.array([unhexlify(value) for value in values], dtype=np.string_)
+        elif ctype == 'fixed':
+            data = np.array(values, dtype=np.string_)
+        elif ctype == 'category':
+            categories = sorted(set(values))
+            codes = dict((value, code) for code, value in enumerate(categories))
+            data = np.array([codes[value] for value in values], dtype=np.uint8)
+            extra[name] = categories
+        else:
+            prefix = common_prefix(values)
+            values = [value[len(prefix):] for value in values]
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in values])
+            offsets = offsets.astype(int_dtype(0, offsets[-1]))
+            np.save(column_path(cat_dir, name, '.offsets'), offsets)
+            data = np.frombuffer(''.join(values), dtype=np.uint8)
+            extra[name] = prefix
+        np.save(column_path(cat_dir, name), data)
+
+        # Sorted index
+        if name in INDEXED_FIELDS and ctype in ('int', 'hex', 'fixed'):
+            order = np.argsort(data, kind='mergesort')
+            np.save(column_path(cat_dir, name, '.order'),
+                    order.astype(int_dtype(0, len(data))))
+
+    # Written last, as it marks the catalog as complete
+    with open(os.path.join(cat_dir, CATALOG_FIELDS), 'w') as f:
+        json.dump({'fields': field_names, 'types': types, 'extra': extra,
+            'rows': len(rows)}, f)
+
+
+class Catalog(object):
+    def __init__(self, cat_dir):
+        self.cat_dir = cat_dir
+        with open(os.path.join(cat_dir, CATALOG_FIELDS), 'r') as f:
+            meta = json.load(f)
+        self.field_names = [str(name) for name in meta['fields']]
+        self.types = meta['types']
+        self.extra = dict((str(name), utf8(value)) for name, value in meta.get('extra', {}).items())
+        self.n_rows = meta['rows']
+        self.columns = {}
+        self.indices = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    # Memory mapped column data
+    def column(self, name):
+        if name not in self.columns:
+            if self.n_rows == 0:
+                self.columns[name] = np.array([])
+            elif self.types[name] == 'str':
+                self.columns[name] = (
+                        np.load(column_path(self.cat_dir, name), mmap_mode='r'),
+                        np.load(column_path(self.cat_dir, name, '.offsets'), mmap_mode='r'))
+            else:
+                self.columns[name] = np.load(column_path(self.cat_dir, name), mmap_mode='r')
+        return self.columns[name]
+
+    # Single value, as a string
+    def value(self, name, idx):
+        data = self.column(name)
+        ctype = self.types[name]
+        if ctype == 'str':
+            data, offsets = data
+            return self.extra.get(name, '') + data[offsets[idx]:offsets[idx+1]].tostring()
+        elif ctype == 'float':
+            return repr(float(data[idx]))
+        elif ctype == 'hex':
+            # Trailing null bytes are stripped by numpy
+            return hexlify(data[idx].ljust(data.dtype.itemsize, '\0'))
+        elif ctype == 'category':
+            return self.extra[name][data[idx]]
+        return str(data[idx])
+
+    # Whole column, as a list of strings
+    def strings(self, name):
+        if self.n_rows == 0:
+            return []
+
+        data = self.column(name)
+        ctype = self.types[name]
+        if ctype == 'str':
+            data, offsets = data
+            prefix = self.extra.get(name, '')
+            buff = data.tostring()
+            offsets = offsets.tolist()
+            return [prefix + buff[start:end] for start, end in izip(offsets, offsets[1:])]
+        elif ctype == 'float':
+            return map(repr, data.tolist())
+        elif ctype == 'hex':
+            size = data.dtype.itemsize
+            return [hexlify(value.ljust(size, '\0')) for value in data.tolist()]
+        elif ctype == 'category':
+            categories = self.extra[name]
+            return [categories[code] for code in data.tolist()]
+        return map(str, data.tolist())
+
+    def row(self, idx):
+        return [self.value(name, idx) for name in self.field_names]
+
+    def rows(self):
+        return imap(list, izip(*[self.strings(name) for name in self.field_names]))
+
+    # Row indices with a given value, using the sorted index
+    def lookup(self, name, value):
+        if name not in self.indices:
+            if not os.path.isfile(column_path(self.cat_dir, name, '.order')):
+                raise KeyError("Column %s is not indexed" % name)
+            order = np.load(column_path(self.cat_dir, name, '.order'))
+            self.indices[name] = (np.asarray(self.column(name))[order], order)
+
+        keys, order = self.indices[name]
+        left = np.searchsorted(keys, value, side='left')
+        right = np.searchsorted(keys, value, side='right')
+        return [int(idx) for idx in order[left:right]]
+
+    def find_pageid(self, page_id):
+        idx = self.lookup('PageID', int(page_id))
+        return idx[0] if idx else None
+
+    def find_sha1(self, sha1):
+        if self.types['ImageSHA1'] == 'hex':
+            return self.lookup('ImageSHA1', unhexlify(sha1))
+        return self.lookup('ImageSHA1', str(sha1))
+
+
+# Convert CSV file to catalog
+def csv_to_catalog(csvfile, cat_dir):
+    reader = csv.reader(csvfile, quoting=csv.QUOTE_ALL, strict=True)
+    field_names = reader.next()
+    rows = list(reader)
+    write_catalog(cat_dir, field_names, rows)
+    print_verbose("Catalog %s: %d rows, %d columns" % (cat_dir, len(rows), len(field_names)), 0)
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    # Convert
+    csv_to_catalog(args.csv, args.catalog)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
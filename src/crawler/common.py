@@ -40,6 +40,15 @@ API_URL = 'https://commons.wikimedia.org/w/api.php'
 
 DEFAULT_DENSITY = 196.3
 
+WINDOW_SIZE = 224
+
+DEFAULT_THREADS = 8
+
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60      # seconds
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024   # bytes
+
+PARALLEL_EXTRACT_MIN = 10000
+
 VG_PREFIX = 'vg'
 NVG_PREFIX = 'nvg'
 LABEL_SEPARATOR = '_'
@@ -48,6 +57,7 @@ VVG_ARTIST = 'Vincent van Gogh'
 
 # Some global values
 verbose_lvl = 0
+api_url = API_URL
 
 
 # Some functions
@@ -73,6 +83,17 @@ def set_verbose_level(lvl):
         verbose_lvl = lvl
 
 
+def get_api_url():
+    global api_url
+    return api_url
+
+
+def set_api_url(url):
+    global api_url
+    if url is not None:
+        api_url = url
+
+
 def print_verbose(msg, lvl):
     if verbose_lvl >= lvl:
         print(msg)
@@ -84,9 +105,12 @@ def pprint_verbose(msg, lvl):
 
 
 @total_ordering
-class ImagePage:
+class ImagePage(object):
+    __slots__ = ['page_id', 'description_url', 'img_url', 'img_sha1',
+            'img_height', 'img_width', 'paint_id', 'artist', 'dim', 'rev_id']
+
     def __init__(self, page_id, description_url, img_url, img_sha1,
-            img_height, img_width, paint_id, artist, dim):
+            img_height, img_width, paint_id, artist, dim, rev_id=None):
         self.page_id = int(page_id)
         self.description_url = description_url
         self.img_url = img_url
@@ -96,6 +120,7 @@ class ImagePage:
         self.paint_id = paint_id
         self.artist = artist
         self.dim = dim
+        self.rev_id = rev_id
 
     def __lt__(self, other):
         return self.page_id < other.page_id
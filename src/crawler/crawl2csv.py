@@ -24,102 +24,195 @@
 Crawl to CSV
 ============================================================
 
-Crawl a given URL and extract raw data to CSV
+Crawl given URLs and extract raw data to CSV
+
+Multiple URLs are crawled concurrently, and pages
+are merged by PageID into a single CSV file.
+
+In streaming mode, rows are appended to the CSV file as
+each batch arrives, and the crawl state is saved alongside
+it, so an interrupted crawl can be resumed.
+
+API responses may be kept in an on-disk cache, which can
+also be replayed offline, without touching the network.
+
+In two-phase mode, the pages of all URLs are listed first,
+with a cheap query, and then fetched in concurrent batches.
+
+In incremental mode, an existing CSV file is refreshed by
+fetching only pages that are new or have changed since it
+was generated, based on the revision IDs saved alongside it.
 
 """
 
 
 import sys
+import os
 import argparse
 import csv
-from re import search
-from crawler import crawl
-from common import set_verbose_level, print_verbose, ImagePage
+import json
+import re
+from multiprocessing import Pool, cpu_count
+from crawler import crawl_many, crawl_gen, crawl_revids, crawl_revisions, \
+        get_site, read_url_list
+from cache import ResponseCache
+from catalog import open_table, table_columns
+from common import set_verbose_level, set_api_url, print_verbose, ImagePage, \
+        dir_type, API_URL, DEFAULT_THREADS, DEFAULT_CACHE_TTL, DEFAULT_CACHE_SIZE, \
+        PARALLEL_EXTRACT_MIN
+
+
+# Template fields of interest
+#   A single scan finds every field name, and each value is then
+#   matched only from where its field starts
+FIELD_REGEX = re.compile(r"(?i)(?:^|\|)\s?(?:"
+        r"(?P<id>id|references|accession number|notes)|"
+        r"(?P<artist>(?:commons_)?(?:artist|author))|"
+        r"(?P<dim>(?:pretty_)?dimensions))\s*=")
+
+VALUE_REGEX = {
+        'id'     : re.compile(r"\s*\[*{*(?P<value>[{\w].*?)}*\]*(?:\n(?:\s*\||\*)|$)"),
+        'artist' : re.compile(r"(?i)\s*{*(?:creator:)?(?P<value>.*?)}*\s*(?:\n\s*\||$)"),
+        'dim'    : re.compile(r"\s*{*(?P<value>.*?)}*(?:\n\s*\||$)") }
+
+
+# Suffix of the crawl state file, used to resume streaming crawls
+STATE_SUFFIX = '.state'
+
+# Suffix of the revision IDs file, used by incremental crawls
+REVIDS_SUFFIX = '.revids'
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('-u', '--url', type=str, required=True,
-            help='page url')
-    parser.add_argument('-c', '--csv', type=argparse.FileType('w'), required=True,
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-u', '--url', type=str, nargs='+',
+            help='page url (multiple urls are merged into a single csv)')
+    group.add_argument('-l', '--list', type=argparse.FileType('r'),
+            help='file containing list of urls to crawl, one per line')
+    parser.add_argument('-c', '--csv', type=str, required=True,
             help='csv file')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS,
+            help='number of concurrent requests (default: %d)' % DEFAULT_THREADS)
+    parser.add_argument('--two-phase', action='store_true',
+            help='list all pages first, then fetch them in concurrent batches')
+    parser.add_argument('-s', '--stream', action='store_true',
+            help='write rows as batches arrive (urls are crawled sequentially, '
+                 'and rows are only sorted within each batch)')
+    parser.add_argument('-r', '--resume', action='store_true',
+            help='resume an interrupted streaming crawl (implies --stream)')
+    parser.add_argument('--cores', type=int, default=cpu_count(),
+            help='number of cores used to extract data from large results (default: %d)' % cpu_count())
+    parser.add_argument('-i', '--incremental', action='store_true',
+            help='refresh existing csv file, fetching only new or changed pages')
+    parser.add_argument('--cache', type=dir_type,
+            help='directory for caching api responses')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+            help='cache entries lifetime in seconds (default: %d)' % DEFAULT_CACHE_TTL)
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+            help='maximum cache size in bytes (default: %d)' % DEFAULT_CACHE_SIZE)
+    parser.add_argument('--offline', action='store_true',
+            help='replay responses from cache only, never touching the network')
+    parser.add_argument('--api', type=str, default=API_URL,
+            help='api url (default: %s)' % API_URL)
     parser.add_argument('-v', '--verbose', action='count', default=0,
             help='verbosity level')
 
     args = parser.parse_args(args=argv)
+    if args.offline and args.cache is None:
+        parser.error('argument --offline requires --cache')
     return args
 
 
-# Extract some raw data from image content
-def extract_image_content(content):
+# Extract template fields from image content
+def extract_image_fields(content):
+
+    values = {}
+
+    # For each field, the first valid value is used
+    for m in FIELD_REGEX.finditer(content):
+        field = m.lastgroup
+        if field in values:
+            continue
+
+        v = VALUE_REGEX[field].match(content, m.end())
+        if v is not None:
+            values[field] = v.group('value')
+            if len(values) == len(VALUE_REGEX):
+                break
 
     # Avoid errors
-    content = content.encode('ascii', errors='backslashreplace')
+    for field in values:
+        if isinstance(values[field], unicode):
+            values[field] = values[field].encode('ascii', errors='backslashreplace')
 
-    # Paint ID
-    m = search(r"(?i)(?:^|\|)\s?(?:id|references|accession number|notes)\s*=\s*\[*{*(?P<id>[{\w].*?)}*\]*(?:\n(?:\s*\||\*)|$)",
-            content)
-    paint_id = m.group('id') if m is not None else None
+    return values
 
-    # Artist
-    m = search(r"(?i)(?:^|\|)\s?(?:commons_)?(?:artist|author)\s*=\s*{*(?:creator:)?(?P<artist>.*?)}*\s*(?:\n\s*\||$)",
-            content)
-    artist = m.group('artist') if m is not None else None
 
-    # Dimensions
-    m = search(r"(?i)(?:^|\|)\s?(?:pretty_)?dimensions\s*=\s*{*(?P<dim>.*?)}*(?:\n\s*\||$)",
-            content)
-    dim = m.group('dim') if m is not None else None
+# Extract some raw data from image content
+def extract_image_content(content):
+    values = extract_image_fields(content)
+    return (values.get('id'), values.get('artist'), values.get('dim'))
 
-    return (paint_id, artist, dim)
 
+# Extract raw data from a single page
+def extract_page(page):
 
-# Extract raw data
-def extract_data(result):
+    # Get ID
+    page_id = page['pageid']
+    print_verbose("Extracting info from %s ..." % page_id, 1)
 
-    img_list = []
+    try:
+        # Image info
+        img_info = page['imageinfo'][0]
+        img_desc_url = img_info['descriptionurl']
+        img_url = img_info['url']
+        img_sha1 = img_info['sha1']
+        img_height = img_info['height']
+        img_width = img_info['width']
 
-    # For each page
-    for page in result.values():
+        # Content
+        img_content = page['revisions'][0]['*']
+        img_rev_id = page['revisions'][0].get('revid')
+        (paint_id, artist, dim) = extract_image_content(img_content)
 
-        # Get ID
-        page_id = page['pageid']
-        print_verbose("Extracting info from %s ..." % page_id, 1)
+        print_verbose("URL is %s" % img_desc_url, 1)
 
-        try:
-            # Image info
-            img_info = page['imageinfo'][0]
-            img_desc_url = img_info['descriptionurl']
-            img_url = img_info['url']
-            img_sha1 = img_info['sha1']
-            img_height = img_info['height']
-            img_width = img_info['width']
+        # Internal object
+        img_page = ImagePage(page_id, img_desc_url, img_url, img_sha1,
+                img_height, img_width,
+                paint_id, artist, dim, img_rev_id)
 
-            # Content
-            img_content = page['revisions'][0]['*']
-            (paint_id, artist, dim) = extract_image_content(img_content)
+        print_verbose(img_page, 3)
+        return img_page
+    except Exception as e:
+        sys.stderr.write("Error processing PageID %s\n" % page_id)
+        sys.stderr.write("-- %s\n" % e)
+        return None
 
-            print_verbose("URL is %s" % img_desc_url, 1)
 
-            # Internal object
-            img_page = ImagePage(page_id, img_desc_url, img_url, img_sha1,
-                    img_height, img_width,
-                    paint_id, artist, dim)
+# Extract raw data
+#   Large results are split among multiple processes
+def extract_data(result, cores=1):
 
-            print_verbose(img_page, 3)
-            img_list.append(img_page)
-        except Exception as e:
-            sys.stderr.write("Error processing PageID %s\n" % page_id)
-            sys.stderr.write("-- %s\n" % e)
+    pages = result.values()
 
+    if cores > 1 and len(pages) >= PARALLEL_EXTRACT_MIN:
+        pool = Pool(processes=cores)
+        img_list = pool.map(extract_page, pages,
+                chunksize=max(1, len(pages) / (4 * cores)))
+        pool.close()
+        pool.join()
+    else:
+        img_list = [extract_page(page) for page in pages]
 
-    return img_list
+    return [img_page for img_page in img_list if img_page is not None]
 
 
 # Save raw image data to CSV file
-def gen_csv(csvfile, page_list):
+def gen_csv(csvfile, page_list, header=True):
 
     # Define writer
     writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
@@ -129,7 +222,8 @@ def gen_csv(csvfile, page_list):
             'PixelHeight', 'PixelWidth',
             'PaintingID', 'Artist', 'RealDimensions']
 
-    writer.writerow(field_names)
+    if header:
+        writer.writerow(field_names)
 
     # For each image
     for page in page_list:
@@ -138,26 +232,214 @@ def gen_csv(csvfile, page_list):
             page.paint_id, page.artist, page.dim])
 
 
+# Read raw image data from CSV file
+def read_csv(csv_path):
+    with open_table(csv_path) as csvfile:
+        columns = table_columns(csvfile, ['PageID',
+            'DescriptionURL', 'ImageURL', 'ImageSHA1',
+            'PixelHeight', 'PixelWidth',
+            'PaintingID', 'Artist', 'RealDimensions'])
+
+        return [ImagePage(*page) for page in zip(*columns)]
+
+
+# Load revision IDs, if any
+def load_revids(revids_path):
+    revids = {}
+    if os.path.isfile(revids_path):
+        with open(revids_path, 'r') as f:
+            for line in f:
+                page_id, rev_id = line.split()
+                revids[int(page_id)] = int(rev_id)
+    return revids
+
+
+# Save revision IDs of pages
+def save_revids(revids_path, page_list, append=False):
+    with open(revids_path, 'a' if append else 'w') as f:
+        for page in page_list:
+            if page.rev_id is not None:
+                f.write("%d %d\n" % (page.page_id, page.rev_id))
+
+
+# Read PageIDs already present in a CSV file
+def read_page_ids(csv_path):
+    with open_table(csv_path) as csvfile:
+        page_ids, = table_columns(csvfile, ['PageID'])
+        return set(int(page_id) for page_id in page_ids)
+
+
+# Load crawl state, if any
+def load_state(state_path):
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+# Save crawl state atomically
+def save_state(state_path, url_param, cont):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'url': url_param, 'continue': cont}, f)
+    os.rename(tmp_path, state_path)
+
+
+# Crawl URLs and append rows to CSV file as each batch arrives
+def stream_csv(csv_path, url_list, resume=False, cache=None, cores=1):
+
+    state_path = csv_path + STATE_SUFFIX
+    url_idx = 0
+    cont = None
+    seen = set()
+
+    # Resume from previous state
+    if resume and os.path.isfile(csv_path) and os.path.getsize(csv_path) > 0:
+        seen = read_page_ids(csv_path)
+        state = load_state(state_path)
+        print_verbose("Resuming with %d pages already in %s" % (len(seen), csv_path), 0)
+
+        if state is not None and state['url'] in url_list:
+            url_idx = url_list.index(state['url'])
+            cont = state['continue']
+
+            # URL was already done
+            if not cont:
+                url_idx += 1
+                cont = None
+
+        csvfile = open(csv_path, 'ab')
+        header = False
+    else:
+        csvfile = open(csv_path, 'wb')
+        header = True
+
+    # All requests share the same site (session)
+    site = get_site(cache)
+
+    for url_param in url_list[url_idx:]:
+        print_verbose("Crawling %s ..." % url_param, 1)
+
+        for pages, next_cont in crawl_gen(url_param, site, cont, cache):
+
+            # Extract data, skipping pages already written
+            raw_data = [page for page in extract_data(pages, cores)
+                    if page.page_id not in seen]
+            raw_data.sort()
+
+            # Append to CSV and make sure it reaches the disk
+            gen_csv(csvfile, raw_data, header)
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+            save_revids(csv_path + REVIDS_SUFFIX, raw_data, not header)
+            header = False
+
+            seen.update(page.page_id for page in raw_data)
+            save_state(state_path, url_param, next_cont)
+            print_verbose("Wrote %d pages (%d total)" % (len(raw_data), len(seen)), 1)
+
+        cont = None
+
+    csvfile.close()
+
+    # Done, state is no longer needed
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+
+
+# Refresh CSV file, fetching only new or changed pages
+def incremental_csv(csv_path, url_list, cache=None, cores=1,
+        threads=DEFAULT_THREADS):
+
+    revids_path = csv_path + REVIDS_SUFFIX
+
+    # Previous data
+    old_data = {}
+    if os.path.isfile(csv_path):
+        old_data = dict((page.page_id, page) for page in read_csv(csv_path))
+    old_revids = load_revids(revids_path)
+
+    # Current revisions
+    site = get_site()
+    revids = {}
+    for url_param in url_list:
+        print_verbose("Checking revisions of %s ..." % url_param, 1)
+        revids.update(crawl_revids(url_param, site))
+
+    # Pages to fetch
+    changed = sorted(revids[page_id] for page_id in revids
+            if old_revids.get(page_id) != revids[page_id]
+            or page_id not in old_data)
+    print_verbose("Fetching %d new or changed pages out of %d" % (len(changed), len(revids)), 0)
+
+    # Unchanged pages keep their previous revisions
+    for page_id, page in old_data.items():
+        page.rev_id = old_revids.get(page_id)
+
+    # Fetch and merge
+    for page in extract_data(crawl_revisions(changed, site, cache, threads), cores):
+        old_data[page.page_id] = page
+
+    raw_data = sorted(old_data.values())
+
+    # Save to CSV atomically
+    tmp_path = csv_path + '.tmp'
+    with open(tmp_path, 'wb') as csvfile:
+        gen_csv(csvfile, raw_data)
+    os.rename(tmp_path, csv_path)
+    save_revids(revids_path, raw_data)
+
+
 # Main
 def main(argv):
 
     # Parse arguments
     args = parse_args(argv)
     set_verbose_level(args.verbose)
+    set_api_url(args.api)
 
     print_verbose("Args: %s" % str(args), 1)
 
-    # Crawl URL
-    result = crawl(args.url)
+    # Get URLs
+    if args.list is not None:
+        url_list = read_url_list(args.list)
+    else:
+        url_list = args.url
+
+    # Response cache
+    cache = None
+    if args.cache is not None:
+        cache = ResponseCache(args.cache, args.cache_ttl, args.cache_size,
+                args.offline)
+
+    # Incremental mode
+    if args.incremental:
+        incremental_csv(args.csv, url_list, cache, args.cores, args.threads)
+        return
+
+    # Streaming mode
+    if args.stream or args.resume:
+        stream_csv(args.csv, url_list, args.resume, cache, args.cores)
+        return
+
+    # Crawl URLs
+    #   The CSV file is kept as it is when nothing could be crawled
+    try:
+        result = crawl_many(url_list, args.threads, cache, args.two_phase)
+    except IOError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
 
     # Extract data
-    raw_data = extract_data(result)
+    raw_data = extract_data(result, args.cores)
 
     # Sort (optional)
     raw_data.sort()
 
     # Save to CSV
-    gen_csv(args.csv, raw_data)
+    with open(args.csv, 'wb') as csvfile:
+        gen_csv(csvfile, raw_data)
+    save_revids(args.csv + REVIDS_SUFFIX, raw_data)
 
 
 
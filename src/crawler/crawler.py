@@ -33,8 +33,11 @@ import sys
 import argparse
 from os.path import basename
 from urllib import unquote_plus
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from wikitools import wiki, api
-from common import set_verbose_level, print_verbose, pprint_verbose, API_URL
+from common import set_verbose_level, print_verbose, pprint_verbose, get_api_url, \
+        DEFAULT_THREADS
 
 
 def parse_args(argv):
@@ -50,7 +53,22 @@ def parse_args(argv):
     return args
 
 
-def crawl(url_param):
+# Properties requested for each page
+DETAIL_PROPS = {
+        'prop'          : 'imageinfo|revisions',
+        'iiprop'        : 'url|sha1|size',
+        'rvprop'        : 'content|ids' }
+
+# Lightweight properties, used to detect changed pages
+INFO_PROPS = {
+        'prop'          : 'info' }
+
+# Maximum number of ids per request
+MAX_IDS = 50
+
+
+# Generate query parameters for a given URL
+def gen_params(url_param, props=DETAIL_PROPS):
 
     # Fix eventual full URL
     url_param = unquote_plus(basename(url_param))
@@ -58,10 +76,8 @@ def crawl(url_param):
     # Generate query
     params = {
             'action'        : 'query',
-            'prop'          : 'imageinfo|revisions',
-            'iiprop'        : 'url|sha1|size',
-            'rvprop'        : 'content',
             'rawcontinue'   : '' }
+    params.update(props)
 
     url_type = get_url_type(url_param)
 
@@ -76,33 +92,287 @@ def crawl(url_param):
         params['titles']    = url_param
         params['gimlimit']  = 'max'
 
+    return params
+
+
+# Get site, unless running offline
+def get_site(cache=None):
+    if cache is not None and cache.offline:
+        return None
+    return wiki.Wiki(get_api_url())
+
+
+# Call API, going through the cache if any
+#   Only results without problems are cached, so errors are
+#   retried instead of being replayed until they expire
+def query_api(site, params, cache=None):
+
+    if cache is not None:
+        result = cache.get(params)
+        if result is not None:
+            return result
 
-    # Call API
-    site = wiki.Wiki(API_URL)
     request = api.APIRequest(site, params)
 
-    print_verbose("Site: %s" % str(site), 2)
     print_verbose("Query: ", 2)
     pprint_verbose(params, 2)
 
-    result = request.query(querycontinue=True)
+    result = request.query(querycontinue=False)
     print_verbose("Result: ", 4)
     pprint_verbose(result, 4)
 
-    # Check result
+    if cache is not None and valid_result(result):
+        cache.put(params, result)
+
+    return result
+
+
+# Check whether API result has no problems
+def valid_result(result):
+    return ('error' not in result and 'warnings' not in result
+            and '-1' not in result.get('query', {}).get('pages', {}))
+
+
+# Check API result, reporting problems to stderr
+def check_result(result):
+
     if 'error' in result:
-        raise Error(result['error'])
+        raise api.APIError(result['error'])
 
     if 'warnings' in result:
-        sys.stderr.write(result['warnings'])
+        sys.stderr.write("%s\n" % result['warnings'])
+        return False
+
+    if '-1' in result.get('query', {}).get('pages', {}):
+        sys.stderr.write("%s\n" % result['query']['pages']['-1'])
+        return False
+
+    return True
+
+
+# Merge pages from a prop continuation into the current batch
+def merge_pages(pages, new_pages):
+    for key, page in new_pages.items():
+        if key not in pages:
+            pages[key] = page
+            continue
+        for prop, value in page.items():
+            if isinstance(value, list) and prop in pages[key]:
+                pages[key][prop].extend(value)
+            else:
+                pages[key][prop] = value
+    return pages
+
+
+# Split continuation values into generator and prop continuations
+def split_continue(params, result):
+    gen_cont = {}
+    prop_cont = {}
+    for module, values in result.get('query-continue', {}).items():
+        if module == params.get('generator'):
+            gen_cont.update(values)
+        else:
+            prop_cont.update(values)
+    return gen_cont, prop_cont
+
+
+# Call API until all props of a batch are complete
+#   Returns a tuple (pages, cont), where cont holds the generator
+#   continuation values, or None if the result has problems
+def query_batch(site, params, cache=None):
+
+    pages = {}
+    prop_cont = {}
+    while True:
+        req_params = params.copy()
+        req_params.update(prop_cont)
+        result = query_api(site, req_params, cache)
+
+        # Check result
+        if not check_result(result):
+            return None
+
+        merge_pages(pages, result.get('query', {}).get('pages', {}))
+
+        gen_cont, prop_cont = split_continue(params, result)
+        if not prop_cont:
+            return pages, gen_cont
+
+
+# Crawl a given URL, yielding pages as each batch is completed
+#   Each item is a tuple (pages, cont), where cont holds the
+#   continuation values for the next batch (empty when done),
+#   so an interrupted crawl can be resumed from it
+def crawl_gen(url_param, site=None, cont=None, cache=None, props=DETAIL_PROPS):
+
+    # Starting point
+    if cont is None:
+        cont = {}
+
+    if site is None:
+        site = get_site(cache)
+    print_verbose("Site: %s" % str(site), 2)
+
+    while True:
+
+        # Generate query
+        params = gen_params(url_param, props)
+        params.update(cont)
+
+        # Call API until the batch is complete
+        batch = query_batch(site, params, cache)
+        if batch is None:
+            return
+
+        pages, gen_cont = batch
+        yield pages, gen_cont
+
+        # Next batch
+        if not gen_cont:
+            break
+        cont = gen_cont
+
+
+def crawl(url_param, site=None, cache=None, props=DETAIL_PROPS):
+
+    pages = None
+    for batch, cont in crawl_gen(url_param, site, cache=cache, props=props):
+        if pages is None:
+            pages = {}
+        pages.update(batch)
+
+    return pages
+
+
+# Get latest revision ID of each page of a given URL
+#   This is a cheap query, as page contents are not requested
+#   Incremental crawls must not use the cache, since these
+#   are meant to detect changes
+def crawl_revids(url_param, site=None, cache=None):
+
+    revids = {}
+    for pages, cont in crawl_gen(url_param, site, cache=cache, props=INFO_PROPS):
+        for page in pages.values():
+            revids[page['pageid']] = page['lastrevid']
+
+    return revids
+
+
+# Crawl a batch of revision IDs (up to MAX_IDS)
+def crawl_revisions_batch(site, cache, props, revid_list):
+
+    params = {
+            'action'        : 'query',
+            'revids'        : '|'.join(str(r) for r in revid_list),
+            'rawcontinue'   : '' }
+    params.update(props)
+
+    try:
+        batch = query_batch(site, params, cache)
+    except Exception as e:
+        sys.stderr.write("Error crawling revisions %s\n" % params['revids'])
+        sys.stderr.write("-- %s\n" % e)
         return None
 
-    if '-1' in result['query']['pages']:
-        sys.stderr.write(result['query']['pages']['-1'])
+    return batch[0] if batch is not None else None
+
+
+# Crawl pages at given revision IDs, in concurrent batches
+#   Revision IDs are part of the query, so cached responses
+#   are only reused while the pages are unchanged
+def crawl_revisions(revid_list, site=None, cache=None, threads=1,
+        props=DETAIL_PROPS):
+
+    if site is None:
+        site = get_site(cache)
+
+    batches = [revid_list[i:i+MAX_IDS] for i in xrange(0, len(revid_list), MAX_IDS)]
+    fn = partial(crawl_revisions_batch, site, cache, props)
+
+    pages = {}
+    pool = ThreadPool(processes=threads)
+
+    # Merge results as they arrive
+    for result in pool.imap_unordered(fn, batches):
+        if result is not None:
+            pages.update(result)
+
+    pool.close()
+    pool.join()
+
+    return pages
+
+
+# Crawl a single URL from a batch, without aborting the whole batch
+def crawl_batch_item(fn, url_param):
+    print_verbose("Crawling %s ..." % url_param, 1)
+    try:
+        return fn(url_param)
+    except Exception as e:
+        sys.stderr.write("Error crawling URL %s\n" % url_param)
+        sys.stderr.write("-- %s\n" % e)
         return None
 
-    return result['query']['pages']
 
+# Crawl multiple URLs concurrently and merge pages by PageID
+#   In two-phase mode, the pages of all URLs are listed first,
+#   and then fetched in concurrent batches of revision IDs
+#   Failed URLs are skipped, unless all of them fail (IOError)
+def crawl_many(url_list, threads=DEFAULT_THREADS, cache=None, two_phase=False,
+        props=DETAIL_PROPS):
+
+    # All requests share the same site (session)
+    site = get_site(cache)
+    print_verbose("Site: %s" % str(site), 2)
+
+    # Revision listings do not use the cache, so that changed pages
+    #   are fetched at their latest revision
+    if two_phase:
+        fn = partial(crawl_revids, site=site, cache=None)
+    else:
+        fn = partial(crawl, site=site, cache=cache, props=props)
+
+    results = {}
+    failures = 0
+    pool = ThreadPool(processes=threads)
+
+    # Merge results as they arrive
+    for result in pool.imap_unordered(partial(crawl_batch_item, fn), url_list):
+        if result is None:
+            failures += 1
+            continue
+
+        for key, value in result.items():
+            page_id = int(key)
+            if page_id in results:
+                print_verbose("Skipping duplicated PageID %s" % page_id, 2)
+                continue
+            results[page_id] = value
+
+    pool.close()
+    pool.join()
+
+    if url_list and failures == len(url_list):
+        raise IOError("Could not crawl any of the %d URLs" % len(url_list))
+    if failures > 0:
+        sys.stderr.write("Could not crawl %d out of %d URLs\n" % (failures, len(url_list)))
+
+    print_verbose("Found %d unique pages from %d URLs" % (len(results), len(url_list)), 0)
+
+    # Fetch details
+    if two_phase:
+        pages = crawl_revisions(sorted(results.values()), site, cache, threads, props)
+        if results and not pages:
+            raise IOError("Could not fetch any of the %d pages" % len(results))
+        return dict((page['pageid'], page) for page in pages.values())
+
+    return results
+
+
+# Read URL list from file, one per line
+def read_url_list(listfile):
+    return [line.strip() for line in listfile
+            if line.strip() and not line.startswith('#')]
 
 
 # Get URL type
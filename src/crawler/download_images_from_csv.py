@@ -26,30 +26,112 @@ Download images from CSV
 
 Download images from a CSV file
 
+Images are downloaded concurrently, reusing keep-alive
+connections to the image hosts. Interrupted downloads are
+kept as partial files, which are resumed on retries and on
+later runs.
+
+With a content-addressed store, each distinct image (by
+SHA1 digest) is downloaded and kept only once, and the
+labelled images in the destination directory are links
+to the store.
+
+Requests are rate limited per host, and the number of
+concurrent downloads adapts to throttling by the servers.
+
+Verified images are recorded in a manifest, along with their
+size and modification time, so they are only checked again
+when these change (or in full verification mode).
+
+In thumbnail mode, images are downloaded as server-side
+thumbnails at the width needed for the standard density,
+instead of the originals. Originals are still downloaded
+when the thumbnail would be too small. Thumbnails cannot
+be checked against the original SHA1 digest, so they are
+recorded in the manifest with their width instead, and
+replaced when the original or another width is wanted.
+
 """
 
 
 import sys
 import os.path
 import argparse
-import csv
-import urllib2
+import errno
+import json
+import httplib
+import socket
 import hashlib
-from progressbar import ProgressBar, Percentage, Bar, \
-        AdaptiveETA, AdaptiveTransferSpeed
+import threading
+import time
+from math import ceil
+from urlparse import urlsplit, urljoin
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from progressbar import ProgressBar, Percentage, Bar, SimpleProgress, AdaptiveETA
 from hurry.filesize import size, alternative
-from common import set_verbose_level, print_verbose, dir_type, \
-        VG_PREFIX, NVG_PREFIX, LABEL_SEPARATOR, VVG_ARTIST
+from crawler import get_site, query_api
+from resize_images import parse_entry_sizes
+from catalog import table_type, table_columns, is_catalog, Catalog
+from scheduler import Scheduler
+from common import set_verbose_level, set_api_url, print_verbose, dir_type, \
+        VG_PREFIX, NVG_PREFIX, LABEL_SEPARATOR, VVG_ARTIST, API_URL, DEFAULT_DENSITY, \
+        DEFAULT_THREADS
+
+
+# Maximum number of redirects per download
+MAX_REDIRECTS = 5
+
+# Block size for downloads and SHA1 digests
+BLOCK_SIZE = 64 * 1024
+
+# Suffix of images being downloaded
+#   Partial downloads are resumed from their size
+PART_SUFFIX = '.part'
+
+# Retries of failed downloads, with exponential backoff (seconds)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+# HTTP status codes worth retrying
+RETRY_STATUS = [416, 429, 500, 502, 503, 504]
+
+# Verification manifest, in the directory of the images
+MANIFEST_NAME = '.manifest'
+
+# Marker of thumbnails in the manifest, in place of the SHA1 digest
+THUMB_MARKER = 'thumb-'
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('-c', '--csv', type=argparse.FileType('r'), required=True,
-            help='csv file')
+    parser.add_argument('-c', '--csv', type=table_type, required=True,
+            help='csv file or catalog')
     parser.add_argument('-d', '--directory', type=dir_type, required=True,
             help='destination directory')
+    parser.add_argument('-j', '--threads', type=int, default=DEFAULT_THREADS,
+            help='maximum number of concurrent downloads (default: %d)' % DEFAULT_THREADS)
+    parser.add_argument('-r', '--rate', type=float, default=0.0,
+            help='maximum number of requests per second to each host (default: unlimited)')
+    parser.add_argument('-m', '--metrics', type=argparse.FileType('w'),
+            help='save download metrics to file (json)')
+    parser.add_argument('-s', '--store', type=dir_type,
+            help='content-addressed store, where images are kept once per SHA1 digest')
+    parser.add_argument('--symlink', action='store_true',
+            help='link images from the store with symbolic links instead of hard links')
+    parser.add_argument('--full-verify', action='store_true',
+            help='check SHA1 of all existing images, regardless of the manifest')
+    parser.add_argument('--cores', type=int, default=cpu_count(),
+            help='number of cores for full verification (default: %d)' % cpu_count())
+    parser.add_argument('-t', '--thumbnail', action='store_true',
+            help='download thumbnails at the standard density, when possible')
+    parser.add_argument('--density', type=float, default=DEFAULT_DENSITY,
+            help='standard density for thumbnails (default: %.2f)' % DEFAULT_DENSITY)
+    parser.add_argument('--api', type=str, default=API_URL,
+            help='api url (default: %s)' % API_URL)
     parser.add_argument('-v', '--verbose', action='count', default=0,
             help='verbosity level')
 
@@ -78,58 +160,404 @@ def parse_entry(dest_dir, page,
 
     return image_path, image_url, image_sha1
 
+# Calculate thumbnail width needed for a given density
+#   Images are resized to fill the final dimensions ("^"),
+#   so the width must cover both final dimensions
+def thumb_width(density, realheight, realwidth, pixelheight, pixelwidth):
+    finalheight, finalwidth = parse_entry_sizes(density, realheight, realwidth)
+    return int(ceil(max(finalwidth, 1.0 * finalheight * pixelwidth / pixelheight)))
+
+# Get thumbnail URL for a given width
+def get_thumb_url(site, pageid, width):
+    params = {
+            'action'        : 'query',
+            'pageids'       : pageid,
+            'prop'          : 'imageinfo',
+            'iiprop'        : 'url',
+            'iiurlwidth'    : width }
+
+    result = query_api(site, params)
+    return result['query']['pages'][str(pageid)]['imageinfo'][0]['thumburl']
+
+class HTTPStatusError(IOError):
+    def __init__(self, status, reason, url, retry_after=None):
+        IOError.__init__(self, "HTTP %d %s: %s" % (status, reason, url))
+        self.status = status
+        self.retry_after = retry_after
+
+# Parse Retry-After header, in seconds (HTTP dates are ignored)
+def parse_retry_after(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+# Keep-alive connections, one per host for each thread
+#   Connections are reused as long as responses are read
+#   to the end, which saves a handshake per image
+#   Requests are paced by the scheduler
+class ConnectionPool(object):
+    def __init__(self, scheduler=None):
+        self.local = threading.local()
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+
+    def connection(self, scheme, host):
+        if not hasattr(self.local, 'conns'):
+            self.local.conns = {}
+
+        key = (scheme, host)
+        if key not in self.local.conns:
+            if scheme == 'https':
+                self.local.conns[key] = httplib.HTTPSConnection(host)
+            else:
+                self.local.conns[key] = httplib.HTTPConnection(host)
+        return self.local.conns[key]
+
+    def discard(self, scheme, host):
+        conn = self.local.conns.pop((scheme, host), None)
+        if conn is not None:
+            conn.close()
+
+    # GET URL, following redirects
+    #   A stale keep-alive connection is replaced once
+    def get(self, url, headers={}):
+        for i in xrange(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+
+            self.scheduler.request(parts.netloc)
+            start = time.time()
+
+            for attempt in xrange(2):
+                conn = self.connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    self.discard(parts.scheme, parts.netloc)
+                    if attempt > 0:
+                        raise
+
+            retry_after = parse_retry_after(response.getheader('Retry-After'))
+            self.scheduler.response(parts.netloc, response.status,
+                    time.time() - start, retry_after)
+
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+
+            if response.status not in (200, 206):
+                response.read()
+                raise HTTPStatusError(response.status, response.reason, url, retry_after)
+
+            return url, response
+
+        raise IOError("Too many redirects: %s" % url)
+
 # Download image
-def download_image(img_path, img_url):
+#   The SHA1 digest is computed over the downloaded blocks, and the
+#   image is written to a temporary file, which is only renamed to
+#   the final path once the digest matches (if one is given)
+#   A previous partial download is resumed with a byte range request
+def download_image(img_path, img_url, pool=None, img_sha1=None):
 
-    # Fetch URL
-    url = urllib2.urlopen(img_url)
-    meta = url.info()
-    file_size = int(meta.getheaders("Content-Length")[0])
-    print_verbose("Downloading image %s (%s)" % (url.geturl(),
-        size(file_size, system=alternative)), 0)
+    if pool is None:
+        pool = ConnectionPool()
 
-    # Set progress bar
-    widgets = ['Progress: ', Percentage(), ' ', Bar(),
-            ' ', AdaptiveETA(), ' ', AdaptiveTransferSpeed()]
-    pbar = ProgressBar(widgets=widgets, maxval=file_size).start()
+    # Partial download
+    part_path = img_path + PART_SUFFIX
+    sha1 = hashlib.sha1()
+    offset = 0
+    headers = {}
+    if os.path.isfile(part_path):
+        offset = update_sha1(sha1, part_path)
+        headers['Range'] = 'bytes=%d-' % offset
+
+    # Fetch URL
+    try:
+        url, response = pool.get(img_url, headers)
+    except HTTPStatusError as e:
+        # Partial download does not fit the image, start over
+        if e.status == 416:
+            os.remove(part_path)
+        raise
+
+    # Start over if the range was not honored
+    if offset > 0 and response.status != 206:
+        offset = 0
+        sha1 = hashlib.sha1()
+
+    file_size = offset + int(response.getheader('Content-Length', 0))
+    print_verbose("Downloading image %s (%s), from byte %d" % (url,
+        size(file_size, system=alternative), offset), 1)
 
     # Download
-    f = open(img_path, 'wb')
     file_size_dl = 0
-    block_sz = 1024 * 8
 
-    while True:
-        buff = url.read(block_sz)
-        if not buff:
-            break
+    with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+        while True:
+            buff = response.read(BLOCK_SIZE)
+            if not buff:
+                break
+
+            file_size_dl += len(buff)
+            sha1.update(buff)
+            f.write(buff)
+            pool.scheduler.transferred(len(buff))
 
-        file_size_dl += len(buff)
-        f.write(buff)
-        pbar.update(file_size_dl)
+    if offset + file_size_dl < file_size:
+        raise IOError("Incomplete download of '%s' (%d of %d bytes)" % (img_path,
+            offset + file_size_dl, file_size))
+
+    # Check SHA1
+    if img_sha1 is not None and img_sha1 != sha1.hexdigest():
+        os.remove(part_path)
+        raise ValueError("File '%s' SHA1 digest does not match" % img_path)
 
     # Done
-    f.close()
-    pbar.finish()
-    return url.getcode()
+    os.rename(part_path, img_path)
+    return file_size_dl
+
+# Update SHA1 digest with file contents, in chunks
+#   Returns the file size
+def update_sha1(sha1, img_path):
+    file_size = 0
+    with open(img_path, 'rb') as f:
+        for buff in iter(lambda: f.read(BLOCK_SIZE), ''):
+            file_size += len(buff)
+            sha1.update(buff)
+    return file_size
 
 # Check SHA1
 def check_sha1(img_path, img_sha1):
     sha1 = hashlib.sha1()
-    with open(img_path, 'rb') as f:
-        sha1.update(f.read())
+    update_sha1(sha1, img_path)
 
     if (img_sha1 != sha1.hexdigest()):
         raise ValueError("File '%s' SHA1 digest does not match" % img_path)
     return True
 
-# Read CSV and download images
-def download_from_csv(csvfile, dest_dir):
+# Download image, retrying with exponential backoff
+#   Each attempt holds a slot of the scheduler, and each retry
+#   resumes from where the previous attempt stopped
+def download_retry(img_path, img_url, pool, img_sha1=None):
+    for attempt in xrange(MAX_RETRIES + 1):
+        try:
+            with pool.scheduler.slot():
+                return download_image(img_path, img_url, pool, img_sha1)
+        except (IOError, httplib.HTTPException) as e:
+            if attempt == MAX_RETRIES or \
+                    (isinstance(e, HTTPStatusError) and e.status not in RETRY_STATUS):
+                raise
+
+            delay = RETRY_BACKOFF * 2 ** attempt
+            if isinstance(e, HTTPStatusError) and e.retry_after is not None:
+                delay = max(delay, e.retry_after)
+            pool.scheduler.retry()
+            print_verbose("Retrying '%s' in %.1f s (%s)" % (img_path, delay, e), 1)
+            time.sleep(delay)
+
+# Verification manifest
+#   Records size, modification time and SHA1 digest of verified
+#   images, so they are only hashed again when their stat changes
+class Manifest(object):
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        self.path = os.path.join(manifest_dir, MANIFEST_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    img_sha1, file_size, mtime, rel_path = line.rstrip('\n').split(' ', 3)
+                    self.entries[rel_path] = (img_sha1, int(file_size), float(mtime))
+        print_verbose("Manifest %s: %d images" % (self.path, len(self.entries)), 1)
+
+    def key(self, img_path):
+        return os.path.relpath(img_path, self.manifest_dir)
+
+    def is_verified(self, img_path, img_sha1):
+        st = os.stat(img_path)
+        with self.lock:
+            entry = self.entries.get(self.key(img_path))
+        return entry == (img_sha1, st.st_size, st.st_mtime)
+
+    def record(self, img_path, img_sha1):
+        st = os.stat(img_path)
+        with self.lock:
+            self.entries[self.key(img_path)] = (img_sha1, st.st_size, st.st_mtime)
+
+    def record_thumb(self, img_path, width):
+        self.record(img_path, THUMB_MARKER + str(width))
+
+    # Width of an unchanged thumbnail, or None if not a thumbnail
+    def thumb_width(self, img_path):
+        with self.lock:
+            entry = self.entries.get(self.key(img_path))
+        if entry is None or not entry[0].startswith(THUMB_MARKER):
+            return None
+        try:
+            st = os.stat(img_path)
+        except OSError:
+            return None
+        if entry[1:] != (st.st_size, st.st_mtime):
+            return None
+        return int(entry[0][len(THUMB_MARKER):])
+
+    def forget(self, img_path):
+        with self.lock:
+            self.entries.pop(self.key(img_path), None)
+
+    # Save manifest atomically
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                for rel_path, (img_sha1, file_size, mtime) in sorted(self.entries.items()):
+                    f.write("%s %d %r %s\n" % (img_sha1, file_size, mtime, rel_path))
+            os.rename(tmp_path, self.path)
+
+# SHA1 digest of a file, for parallel verification
+def file_sha1(img_path):
+    sha1 = hashlib.sha1()
+    update_sha1(sha1, img_path)
+    return img_path, sha1.hexdigest()
+
+# Check SHA1 of all given existing images, in parallel
+#   All mismatches are reported before failing
+def full_verify(manifest, entries, cores):
+    digests = dict((img_path, img_sha1) for img_path, img_url, img_sha1, pageid, thumb
+            in entries if thumb is None and os.access(img_path, os.R_OK))
+    print_verbose("Verifying %d images with %d cores" % (len(digests), cores), 0)
+
+    mismatches = 0
+    pool = Pool(processes=cores)
+    for img_path, img_sha1 in pool.imap_unordered(file_sha1, digests.keys(), chunksize=16):
+        if img_sha1 == digests[img_path]:
+            manifest.record(img_path, img_sha1)
+        else:
+            mismatches += 1
+            sys.stderr.write("File '%s' SHA1 digest does not match\n" % img_path)
+    pool.close()
+    pool.join()
+
+    manifest.save()
+    if mismatches > 0:
+        raise ValueError("%d files do not match their SHA1 digests" % mismatches)
+
+# Remove thumbnails of previous runs that are no longer wanted
+#   Either the original or a thumbnail of another width is wanted
+def remove_thumbs(manifest, entries):
+    for img_path, img_url, img_sha1, pageid, thumb in entries:
+        width = manifest.thumb_width(img_path)
+        if width is not None and width != thumb:
+            print_verbose("Replacing thumbnail %s (width %d)" % (img_path, width), 1)
+            os.remove(img_path)
+            manifest.forget(img_path)
+
+# Download a single image, unless it already exists, and check it
+#   Returns the number of bytes downloaded
+def download_entry(pool, site, manifest, entry):
+    img_path, img_url, img_sha1, pageid, thumb = entry
+
+    # Existing images are checked, unless already verified
+    #   (thumbnails differ from the original)
+    if os.access(img_path, os.R_OK):
+        if thumb is None and not manifest.is_verified(img_path, img_sha1):
+            check_sha1(img_path, img_sha1)
+            manifest.record(img_path, img_sha1)
+        return 0
+
+    # Download, checking SHA1 on the fly
+    if thumb is not None:
+        file_size_dl = download_retry(img_path, get_thumb_url(site, pageid, thumb), pool)
+        manifest.record_thumb(img_path, thumb)
+        return file_size_dl
+    file_size_dl = download_retry(img_path, img_url, pool, img_sha1)
+    manifest.record(img_path, img_sha1)
+    return file_size_dl
+
+# Path of an image in the content-addressed store
+def blob_path(store_dir, img_sha1, img_url):
+    file_extension = os.path.splitext(img_url)[1]
+    return os.path.join(store_dir, img_sha1[:2], img_sha1 + file_extension)
+
+# Replace entries by one entry per distinct image in the store
+#   Returns a tuple (entries, links), where links are the pairs
+#   (blob path, image path) to be linked after downloading
+#   Images already present in the destination directory are
+#   added to the store, so they are not downloaded again
+#   Thumbnails are not stored, as they differ from the original
+#   Entries are in table order, and find_sha1, if given, looks up
+#   the rows of a SHA1 digest in the table index
+def store_entries(store_dir, entries, find_sha1=None):
+    first = {}
+    n_blobs = 0
+    store_list = []
+    links = []
+
+    for idx, entry in enumerate(entries):
+        img_path, img_url, img_sha1, pageid, thumb = entry
+        if thumb is not None:
+            store_list.append(entry)
+            continue
+
+        # First full-size entry of the same image
+        if find_sha1 is not None:
+            first_idx = min(i for i in find_sha1(img_sha1) if entries[i][4] is None)
+        else:
+            first_idx = first.setdefault(img_sha1, idx)
+
+        blob = blob_path(store_dir, img_sha1, entries[first_idx][1])
+        links.append((blob, img_path))
+
+        if first_idx == idx:
+            n_blobs += 1
+            store_list.append((blob, img_url, img_sha1, pageid, None))
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+        else:
+            print_verbose("Image %s is a duplicate of %s" % (img_path, blob), 2)
+
+        if not os.path.exists(blob) and os.path.isfile(img_path) \
+                and not os.path.islink(img_path):
+            try:
+                os.link(img_path, blob)
+            except OSError:
+                pass
+
+    print_verbose("%d images, %d distinct in store" % (len(links), n_blobs), 0)
+    return store_list, links
+
+# Link image path to the store
+#   Hard links fall back to symbolic links across file systems
+def link_image(blob, img_path, symlink=False):
+    if os.path.lexists(img_path):
+        return
+
+    if not symlink:
+        try:
+            os.link(blob, img_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    os.symlink(os.path.abspath(blob), img_path)
 
-    # Define writer
-    reader = csv.reader(csvfile, quoting=csv.QUOTE_ALL, strict=True)
+# Read CSV and download images
+def download_from_csv(csvfile, dest_dir, thumbnail=False, density=DEFAULT_DENSITY,
+        threads=DEFAULT_THREADS, store_dir=None, symlink=False,
+        verify=False, cores=1, rate=0.0):
 
-    # Field names
-    field_names = reader.next()
+    # Read only the needed columns
+    field_names = ['PageID', 'ImageURL', 'ImageSHA1', 'Artist']
+    if thumbnail:
+        field_names += ['PixelHeight', 'PixelWidth', 'RealHeightInches', 'RealWidthInches']
+    columns = table_columns(csvfile, field_names)
 
     # Indices
     idx_pageid = field_names.index('PageID')
@@ -137,19 +565,83 @@ def download_from_csv(csvfile, dest_dir):
     idx_sha1 = field_names.index('ImageSHA1')
     idx_artist = field_names.index('Artist')
 
+    site = None
+    if thumbnail:
+        idx_pixelheight = field_names.index('PixelHeight')
+        idx_pixelwidth = field_names.index('PixelWidth')
+        idx_realheight = field_names.index('RealHeightInches')
+        idx_realwidth = field_names.index('RealWidthInches')
+        site = get_site()
+
     # For each page entry
-    for page in reader:
+    entries = []
+    for page in zip(*columns):
 
         # Parse entry
         img_path, img_url, img_sha1 = parse_entry(dest_dir, page,
                 idx_pageid, idx_imageurl, idx_sha1, idx_artist)
 
-        # Download only if image does not exist
-        if (not os.access(img_path, os.R_OK)):
-            download_image(img_path, img_url)
+        # Use thumbnail only if it is smaller than the original
+        thumb = None
+        if thumbnail:
+            pixelwidth = int(page[idx_pixelwidth])
+            width = thumb_width(density,
+                    float(page[idx_realheight]), float(page[idx_realwidth]),
+                    int(page[idx_pixelheight]), pixelwidth)
+            if width < pixelwidth:
+                thumb = width
+            print_verbose("Image %s: thumbnail width %d, original width %d" % (img_path,
+                width, pixelwidth), 2)
+
+        entries.append((img_path, img_url, img_sha1, page[idx_pageid], thumb))
+
+    # Verified images and thumbnails, kept with the images themselves
+    manifest = Manifest(store_dir if store_dir is not None else dest_dir)
+    remove_thumbs(manifest, entries)
+
+    # Download each distinct image only once
+    links = []
+    if store_dir is not None:
+        find_sha1 = None
+        if isinstance(csvfile, basestring) and is_catalog(csvfile):
+            find_sha1 = Catalog(csvfile).find_sha1
+        entries, links = store_entries(store_dir, entries, find_sha1)
+
+    if verify:
+        full_verify(manifest, entries, cores)
+
+    # Set progress bar
+    widgets = ['Progress: ', Percentage(), ' ', Bar(),
+            ' ', SimpleProgress(), ' ', AdaptiveETA()]
+    pbar = ProgressBar(widgets=widgets, maxval=max(len(entries), 1)).start()
+
+    # Download concurrently
+    #   The scheduler adapts concurrency up to the number of threads
+    scheduler = Scheduler(threads, rate)
+    pool = ThreadPool(processes=threads)
+    fn = partial(download_entry, ConnectionPool(scheduler), site, manifest)
+
+    try:
+        for count, file_size_dl in enumerate(pool.imap_unordered(fn, entries), 1):
+            pbar.update(count)
+    finally:
+        pool.terminate()
+        pool.join()
+        manifest.save()
+
+    # Link images to the store
+    for blob, img_path in links:
+        link_image(blob, img_path, symlink)
 
-        # Check SHA1
-        check_sha1(img_path, img_sha1)
+    # Done
+    pbar.finish()
+    metrics = scheduler.metrics()
+    print_verbose("Downloaded %s in %.1f s (%s/s)" % (size(metrics['bytes'], system=alternative),
+        metrics['elapsed'], size(int(metrics['bytes'] / metrics['elapsed']), system=alternative)), 0)
+    print_verbose("Requests: %d, retries: %d, throttled: %d, concurrency: %d (max %d), queue depth: max %d" % (
+        metrics['requests'], metrics['retries'], metrics['throttled'],
+        metrics['concurrency'], metrics['max_concurrency'], metrics['max_queue_depth']), 0)
+    return metrics
 
 
 # Main
@@ -158,11 +650,18 @@ def main(argv):
     # Parse arguments
     args = parse_args(argv)
     set_verbose_level(args.verbose)
+    set_api_url(args.api)
 
     print_verbose("Args: %s" % str(args), 1)
 
     # Download images
-    download_from_csv(args.csv, args.directory)
+    metrics = download_from_csv(args.csv, args.directory, args.thumbnail, args.density,
+            args.threads, args.store, args.symlink, args.full_verify, args.cores,
+            args.rate)
+
+    # Save metrics
+    if args.metrics is not None:
+        json.dump(metrics, args.metrics, indent=1, sort_keys=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+# near_duplicates.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Near duplicates
+============================================================
+
+Find near-duplicate images with perceptual hashes
+
+A 64-bit perceptual hash (DCT of a 32x32 grayscale image) is
+computed for each image, either from small thumbnails from
+Commons, before anything else is downloaded, or from images
+in a directory. Hashes within a Hamming distance threshold
+are found with a BK-tree, and grouped into clusters.
+
+Images are taken by decreasing number of pixels (then by
+increasing PageID), and each image not yet in a cluster is
+kept, gathering the other images within the threshold of it
+that are not yet in a cluster. The other rows of the CSV
+file are marked as duplicates of the image they were
+gathered by, or filtered out, so each duplicate is within
+the threshold of the image it is a duplicate of.
+
+Hashes can be saved to a file, so they are not computed
+again on later runs.
+
+"""
+
+
+import sys
+import os
+import argparse
+import csv
+import numpy as np
+from StringIO import StringIO
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+from crawler import get_site, query_api, MAX_IDS
+from download_images_from_csv import ConnectionPool
+from probe_images import parse_pageid
+from catalog import table_type, table_reader
+from common import set_verbose_level, set_api_url, print_verbose, dir_type, \
+        API_URL, DEFAULT_THREADS
+
+
+HASH_SIZE = 8
+SAMPLE_SIZE = 4 * HASH_SIZE
+DEFAULT_THRESHOLD = 8
+DEFAULT_THUMB_WIDTH = 128
+
+DUPLICATE_FIELDS = ['PHash', 'DuplicateOf']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-c', '--csv', type=table_type, required=True,
+            help='csv file or catalog')
+    parser.add_argument('-d', '--directory', type=dir_type,
+            help='hash images in this directory, instead of thumbnails from Commons')
+    parser.add_argument('-o', '--output', type=argparse.FileType('wb'),
+            help='output csv file (default: stdout)')
+    parser.add_argument('--hashes', type=str,
+            help='file where computed hashes are kept across runs')
+    parser.add_argument('-t', '--threshold', type=int, default=DEFAULT_THRESHOLD,
+            help='maximum Hamming distance of near duplicates (default: %d)' % DEFAULT_THRESHOLD)
+    parser.add_argument('-w', '--width', type=int, default=DEFAULT_THUMB_WIDTH,
+            help='width of thumbnails (default: %d)' % DEFAULT_THUMB_WIDTH)
+    parser.add_argument('-f', '--filter', action='store_true',
+            help='remove duplicated rows, instead of marking them')
+    parser.add_argument('-j', '--threads', type=int, default=DEFAULT_THREADS,
+            help='number of concurrent thumbnail downloads (default: %d)' % DEFAULT_THREADS)
+    parser.add_argument('--cores', type=int, default=cpu_count(),
+            help='number of cores for hashing images in a directory (default: %d)' % cpu_count())
+    parser.add_argument('--api', type=str, default=API_URL,
+            help='api url (default: %s)' % API_URL)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+# DCT-II matrix (orthonormal)
+def dct_matrix(n):
+    k = np.arange(n).reshape((n, 1))
+    m = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2.0 * n))
+    m[0] /= np.sqrt(2)
+    return m
+
+DCT_MATRIX = dct_matrix(SAMPLE_SIZE)
+
+
+# Perceptual hash of an image
+#   Bits of the lowest frequencies of the DCT, above their median
+#   (not considering the DC coefficient)
+def phash(img):
+    img = img.convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.ANTIALIAS)
+    pixels = np.asarray(img, dtype=np.float64)
+    dct = DCT_MATRIX.dot(pixels).dot(DCT_MATRIX.T)
+
+    low = dct[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low > np.median(low[1:])
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# BK-tree of hashes, for nearest neighbor queries in Hamming space
+#   Each node is a tuple (hash, items, children by distance)
+class BKTree(object):
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, h, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (h, [item], {})
+            return
+
+        node = self.root
+        while True:
+            dist = hamming(h, node[0])
+            if dist == 0:
+                node[1].append(item)
+                return
+            if dist not in node[2]:
+                node[2][dist] = (h, [item], {})
+                return
+            node = node[2][dist]
+
+    # Items within a given distance, as tuples (distance, item)
+    def search(self, h, radius):
+        results = []
+        stack = [self.root] if self.root is not None else []
+
+        while stack:
+            node = stack.pop()
+            dist = hamming(h, node[0])
+            if dist <= radius:
+                results.extend((dist, item) for item in node[1])
+            for child_dist, child in node[2].items():
+                if dist - radius <= child_dist <= dist + radius:
+                    stack.append(child)
+
+        return results
+
+
+# Hash image file, decoding JPEG images at reduced size
+def hash_file(img_path):
+    try:
+        img = Image.open(img_path)
+        img.draft('L', (SAMPLE_SIZE, SAMPLE_SIZE))
+        return img_path, phash(img)
+    except Exception as e:
+        sys.stderr.write("Could not hash %s: %s\n" % (img_path, e))
+        return img_path, None
+
+
+# Hash images in a directory, by PageID
+def hash_dir(img_dir, pageids, cores=1):
+    paths = {}
+    for fname in os.listdir(img_dir):
+        pageid = parse_pageid(fname)
+        if pageid in pageids and not fname.startswith('.') and not fname.endswith('.part'):
+            paths[os.path.join(img_dir, fname)] = pageid
+
+    pool = Pool(processes=cores)
+    hashes = {}
+    for img_path, h in pool.imap_unordered(hash_file, paths.keys(), chunksize=16):
+        if h is not None:
+            hashes[paths[img_path]] = h
+    pool.close()
+    pool.join()
+
+    return hashes
+
+
+# Get thumbnail URLs of a batch of pages (up to MAX_IDS)
+def get_thumb_urls(site, width, pageids):
+    params = {
+            'action'        : 'query',
+            'pageids'       : '|'.join(pageids),
+            'prop'          : 'imageinfo',
+            'iiprop'        : 'url',
+            'iiurlwidth'    : width }
+
+    try:
+        result = query_api(site, params)
+    except Exception as e:
+        sys.stderr.write("Error getting thumbnails of %s: %s\n" % (params['pageids'], e))
+        return []
+
+    urls = []
+    for page in result.get('query', {}).get('pages', {}).values():
+        try:
+            urls.append((str(page['pageid']), page['imageinfo'][0]['thumburl']))
+        except (KeyError, IndexError):
+            pass
+    return urls
+
+
+# Hash thumbnail
+def hash_thumb(pool, item):
+    pageid, url = item
+    try:
+        url, response = pool.get(url)
+        return pageid, phash(Image.open(StringIO(response.read())))
+    except Exception as e:
+        sys.stderr.write("Could not hash thumbnail of %s: %s\n" % (pageid, e))
+        return pageid, None
+
+
+# Hash thumbnails from Commons, by PageID
+def hash_thumbs(pageids, width, threads=DEFAULT_THREADS):
+    site = get_site()
+    pageids = sorted(pageids)
+    batches = [pageids[i:i+MAX_IDS] for i in xrange(0, len(pageids), MAX_IDS)]
+
+    pool = ThreadPool(processes=threads)
+    urls = [item for batch in pool.imap_unordered(partial(get_thumb_urls, site, width), batches)
+            for item in batch]
+
+    hashes = {}
+    for pageid, h in pool.imap_unordered(partial(hash_thumb, ConnectionPool()), urls):
+        if h is not None:
+            hashes[pageid] = h
+    pool.close()
+    pool.join()
+
+    return hashes
+
+
+# Load hashes, if any
+def load_hashes(hashes_path):
+    hashes = {}
+    if hashes_path is not None and os.path.isfile(hashes_path):
+        with open(hashes_path, 'r') as f:
+            for line in f:
+                pageid, h = line.split()
+                hashes[pageid] = int(h, 16)
+    return hashes
+
+
+# Save hashes
+def save_hashes(hashes_path, hashes):
+    with open(hashes_path, 'w') as f:
+        for pageid in sorted(hashes, key=int):
+            f.write("%s %016x\n" % (pageid, hashes[pageid]))
+
+
+# Group near duplicates
+#   Returns a dictionary with the representative of each PageID,
+#   which is the one with the highest rank in its cluster
+#   Clusters are stars (not chains), so every image is within the
+#   threshold of its representative: images are taken by decreasing
+#   rank, and each one not yet in a cluster gathers the others
+#   within the threshold that are not yet in a cluster
+def cluster_hashes(hashes, rank, threshold=DEFAULT_THRESHOLD):
+    tree = BKTree()
+    for pageid in sorted(hashes, key=int):
+        tree.add(hashes[pageid], pageid)
+
+    representative = {}
+    n_clusters = 0
+    for pageid in sorted(hashes, key=rank, reverse=True):
+        if pageid in representative:
+            continue
+
+        n_clusters += 1
+        representative[pageid] = pageid
+        for dist, other in tree.search(hashes[pageid], threshold):
+            representative.setdefault(other, pageid)
+
+    print_verbose("%d images, %d distinct" % (len(hashes), n_clusters), 1)
+    return representative
+
+
+# Mark (or filter) near duplicates in CSV file
+def dedup_csv(csvfile, output, img_dir=None, hashes_path=None,
+        threshold=DEFAULT_THRESHOLD, width=DEFAULT_THUMB_WIDTH, filter_rows=False,
+        threads=DEFAULT_THREADS, cores=1):
+
+    # Read rows
+    reader = table_reader(csvfile)
+    field_names = reader.next()
+    idx_pageid = field_names.index('PageID')
+    rows = list(reader)
+
+    # Rank by number of pixels, then by lowest PageID
+    pixels = {}
+    if 'PixelHeight' in field_names and 'PixelWidth' in field_names:
+        idx_pixelheight = field_names.index('PixelHeight')
+        idx_pixelwidth = field_names.index('PixelWidth')
+        for page in rows:
+            pixels[page[idx_pageid]] = int(page[idx_pixelheight]) * int(page[idx_pixelwidth])
+
+    def rank(pageid):
+        return (pixels.get(pageid, 0), -int(pageid))
+
+    # Hash images not hashed yet
+    hashes = load_hashes(hashes_path)
+    missing = set(page[idx_pageid] for page in rows) - set(hashes)
+    print_verbose("Hashing %d images (%d already hashed)" % (len(missing),
+        len(rows) - len(missing)), 1)
+
+    if missing:
+        if img_dir is not None:
+            hashes.update(hash_dir(img_dir, missing, cores))
+        else:
+            hashes.update(hash_thumbs(missing, width, threads))
+        if hashes_path is not None:
+            save_hashes(hashes_path, hashes)
+
+    # Cluster
+    representative = cluster_hashes(dict((page[idx_pageid], hashes[page[idx_pageid]])
+        for page in rows if page[idx_pageid] in hashes), rank, threshold)
+
+    # Write rows
+    writer = csv.writer(output, quoting=csv.QUOTE_ALL, strict=True)
+    writer.writerow(field_names + DUPLICATE_FIELDS)
+
+    for page in rows:
+        pageid = page[idx_pageid]
+        h = '%016x' % hashes[pageid] if pageid in hashes else ''
+        dup_of = representative.get(pageid, pageid)
+        if dup_of == pageid:
+            dup_of = ''
+        elif filter_rows:
+            continue
+        writer.writerow(page + [h, dup_of])
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+    set_api_url(args.api)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    # Find near duplicates
+    output = args.output if args.output is not None else sys.stdout
+    dedup_csv(args.csv, output, args.directory, args.hashes, args.threshold,
+            args.width, args.filter, args.threads, args.cores)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+
+# probe_images.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Probe images
+============================================================
+
+Probe dimensions and JPEG quality from image headers
+
+Only image headers are read: dimensions from JPEG, PNG and
+TIFF headers, and JPEG quality is estimated from the
+quantization tables, as a scaling of the standard (IJG)
+tables. Images in a directory are probed concurrently.
+
+Given a CSV file, its rows are flagged, or filtered out,
+when the image is missing, its format is unknown, or its
+JPEG quality is below a minimum (default: 75).
+
+"""
+
+
+import sys
+import os
+import argparse
+import csv
+from struct import unpack
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from catalog import table_type, table_reader
+from common import set_verbose_level, print_verbose, dir_type, \
+        LABEL_SEPARATOR, DEFAULT_THREADS
+
+
+DEFAULT_MIN_QUALITY = 75
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# JPEG start of frame markers (excluding DHT, JPG and DAC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# JPEG markers without length
+STANDALONE_MARKERS = set([0x01, 0xD8] + range(0xD0, 0xD8))
+
+# Standard (IJG) quantization tables, luminance and chrominance
+STD_LUMINANCE = [
+        16,  11,  10,  16,  24,  40,  51,  61,
+        12,  12,  14,  19,  26,  58,  60,  55,
+        14,  13,  16,  24,  40,  57,  69,  56,
+        14,  17,  22,  29,  51,  87,  80,  62,
+        18,  22,  37,  56,  68, 109, 103,  77,
+        24,  35,  55,  64,  81, 104, 113,  92,
+        49,  64,  78,  87, 103, 121, 120, 101,
+        72,  92,  95,  98, 112, 100, 103,  99 ]
+STD_CHROMINANCE = [
+        17,  18,  24,  47,  99,  99,  99,  99,
+        18,  21,  26,  66,  99,  99,  99,  99,
+        24,  26,  56,  99,  99,  99,  99,  99,
+        47,  66,  99,  99,  99,  99,  99,  99 ] + [99] * 32
+
+# Natural order of coefficients, by zigzag order (as in DQT)
+ZIGZAG = [
+         0,  1,  8, 16,  9,  2,  3, 10,
+        17, 24, 32, 25, 18, 11,  4,  5,
+        12, 19, 26, 33, 40, 48, 41, 34,
+        27, 20, 13,  6,  7, 14, 21, 28,
+        35, 42, 49, 56, 57, 50, 43, 36,
+        29, 22, 15, 23, 30, 37, 44, 51,
+        58, 59, 52, 45, 38, 31, 39, 46,
+        53, 60, 61, 54, 47, 55, 62, 63 ]
+
+# TIFF tags and types
+TIFF_WIDTH = 256
+TIFF_HEIGHT = 257
+TIFF_SHORT = 3
+TIFF_LONG = 4
+
+# Flags
+FLAG_MISSING = 'missing'
+FLAG_UNKNOWN = 'unknown_format'
+FLAG_LOW_QUALITY = 'low_quality'
+
+PROBE_FIELDS = ['ProbeHeight', 'ProbeWidth', 'JPEGQuality', 'Flag']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-d', '--directory', type=dir_type, required=True,
+            help='directory containing images')
+    parser.add_argument('-c', '--csv', type=table_type,
+            help='csv file or catalog to be flagged')
+    parser.add_argument('-o', '--output', type=argparse.FileType('wb'),
+            help='output csv file (default: stdout)')
+    parser.add_argument('-q', '--min-quality', type=int, default=DEFAULT_MIN_QUALITY,
+            help='minimum JPEG quality (default: %d)' % DEFAULT_MIN_QUALITY)
+    parser.add_argument('-f', '--filter', action='store_true',
+            help='remove flagged rows, instead of flagging them')
+    parser.add_argument('-t', '--threads', type=int, default=DEFAULT_THREADS,
+            help='number of concurrent probes (default: %d)' % DEFAULT_THREADS)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+# Estimate JPEG quality from quantization tables
+#   Tables are taken as the standard ones scaled by the IJG
+#   quality factor, so the scaling is the ratio of their sums
+#   Values clamped to the limits (1 and 255) are not considered
+def jpeg_quality(tables):
+    if 0 not in tables:
+        return None
+
+    pairs = [(tables[0][k], STD_LUMINANCE[ZIGZAG[k]]) for k in xrange(64)]
+    if 1 in tables:
+        pairs += [(tables[1][k], STD_CHROMINANCE[ZIGZAG[k]]) for k in xrange(64)]
+
+    unclamped = [(actual, expected) for actual, expected in pairs
+            if 1 < actual < 255]
+    if not unclamped:
+        return 100 if all(actual == 1 for actual, expected in pairs) else 1
+
+    scaling = 100.0 * sum(actual for actual, expected in unclamped) / \
+            sum(expected for actual, expected in unclamped)
+    if scaling <= 100:
+        quality = (200 - scaling) / 2
+    else:
+        quality = 5000 / scaling
+    return int(round(min(100, max(1, quality))))
+
+
+# Probe JPEG headers, up to the start of scan
+def probe_jpeg(f):
+    height = width = None
+    tables = {}
+
+    f.seek(2)
+    while True:
+        # Next marker
+        c = f.read(1)
+        while c and c != '\xff':
+            c = f.read(1)
+        while c == '\xff':
+            c = f.read(1)
+        if not c:
+            break
+
+        marker = ord(c)
+        if marker in STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+
+        length = unpack('>H', f.read(2))[0]
+
+        # Quantization tables
+        if marker == 0xDB:
+            data = f.read(length - 2)
+            while data:
+                precision, table_id = ord(data[0]) >> 4, ord(data[0]) & 0x0F
+                if precision:
+                    tables[table_id] = unpack('>64H', data[1:129])
+                    data = data[129:]
+                else:
+                    tables[table_id] = unpack('>64B', data[1:65])
+                    data = data[65:]
+
+        # Frame header
+        elif marker in SOF_MARKERS:
+            height, width = unpack('>HH', f.read(5)[1:])
+            f.seek(length - 7, 1)
+
+        else:
+            f.seek(length - 2, 1)
+
+    return height, width, jpeg_quality(tables)
+
+
+# Probe PNG header
+def probe_png(f):
+    f.seek(16)
+    width, height = unpack('>II', f.read(8))
+    return height, width, None
+
+
+# Probe TIFF header (first image)
+def probe_tiff(f, endian):
+    f.seek(4)
+    f.seek(unpack(endian + 'I', f.read(4))[0])
+    n_entries = unpack(endian + 'H', f.read(2))[0]
+
+    dims = {}
+    for i in xrange(n_entries):
+        tag, tag_type, count, value = unpack(endian + 'HHI4s', f.read(12))
+        if tag in (TIFF_WIDTH, TIFF_HEIGHT):
+            if tag_type == TIFF_SHORT:
+                dims[tag] = unpack(endian + 'H', value[:2])[0]
+            elif tag_type == TIFF_LONG:
+                dims[tag] = unpack(endian + 'I', value)[0]
+
+    return dims.get(TIFF_HEIGHT), dims.get(TIFF_WIDTH), None
+
+
+# Probe image headers
+#   Returns a tuple (format, height, width, quality), where
+#   unknown values are None
+def probe_image(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            magic = f.read(8)
+            if magic[:2] == '\xff\xd8':
+                return ('JPEG',) + probe_jpeg(f)
+            elif magic == PNG_SIGNATURE:
+                return ('PNG',) + probe_png(f)
+            elif magic[:4] == 'II*\x00':
+                return ('TIFF',) + probe_tiff(f, '<')
+            elif magic[:4] == 'MM\x00*':
+                return ('TIFF',) + probe_tiff(f, '>')
+    except Exception as e:
+        print_verbose("Could not probe %s: %s" % (filepath, e), 1)
+
+    return (None, None, None, None)
+
+
+def probe_file(img_dir, fname):
+    return fname, probe_image(os.path.join(img_dir, fname))
+
+
+# Probe all images in a directory, concurrently
+#   Returns a dictionary of probes by file name
+def probe_dir(img_dir, threads=DEFAULT_THREADS):
+    fnames = [fname for fname in sorted(os.listdir(img_dir))
+            if not fname.startswith('.') and not fname.endswith('.part')
+            and os.path.isfile(os.path.join(img_dir, fname))]
+
+    pool = ThreadPool(processes=threads)
+    probes = dict(pool.imap_unordered(partial(probe_file, img_dir), fnames, chunksize=16))
+    pool.close()
+    pool.join()
+
+    print_verbose("Probed %d images" % len(probes), 1)
+    return probes
+
+
+# PageID from image file name (label and PageID)
+def parse_pageid(fname):
+    return os.path.splitext(fname)[0].split(LABEL_SEPARATOR)[-1]
+
+
+# Flags of a given probe
+def probe_flags(probe, min_quality):
+    if probe is None:
+        return [FLAG_MISSING]
+
+    fmt, height, width, quality = probe
+    if height is None:
+        return [FLAG_UNKNOWN]
+    if quality is not None and quality < min_quality:
+        return [FLAG_LOW_QUALITY]
+    return []
+
+
+# Flag (or filter) CSV rows by probing their images
+def flag_csv(csvfile, img_dir, output, min_quality=DEFAULT_MIN_QUALITY,
+        filter_rows=False, threads=DEFAULT_THREADS):
+
+    # Probe images
+    probes = dict((parse_pageid(fname), probe)
+            for fname, probe in probe_dir(img_dir, threads).items())
+
+    # Define reader and writer
+    reader = table_reader(csvfile)
+    writer = csv.writer(output, quoting=csv.QUOTE_ALL, strict=True)
+
+    field_names = reader.next()
+    idx_pageid = field_names.index('PageID')
+    writer.writerow(field_names + PROBE_FIELDS)
+
+    n_rows = n_flagged = 0
+    for page in reader:
+        n_rows += 1
+        probe = probes.get(page[idx_pageid])
+        flags = probe_flags(probe, min_quality)
+
+        if flags:
+            n_flagged += 1
+            print_verbose("PageID %s: %s" % (page[idx_pageid], ', '.join(flags)), 1)
+            if filter_rows:
+                continue
+
+        fmt, height, width, quality = probe if probe is not None else (None,) * 4
+        writer.writerow(page + ['' if v is None else str(v)
+            for v in (height, width, quality)] + ['|'.join(flags)])
+
+    print_verbose("%d rows, %d flagged" % (n_rows, n_flagged), 1)
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    output = args.output if args.output is not None else sys.stdout
+
+    # Flag CSV
+    if args.csv is not None:
+        flag_csv(args.csv, args.directory, output, args.min_quality,
+                args.filter, args.threads)
+        return
+
+    # Otherwise, list images by quality (as identify -format "%f:%Q")
+    probes = probe_dir(args.directory, args.threads)
+    for fname, (fmt, height, width, quality) in sorted(probes.items(),
+            key=lambda item: (-(item[1][3] or 0), item[0])):
+        output.write("%s:%s\n" % (fname, quality if quality is not None else ''))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
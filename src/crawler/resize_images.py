@@ -26,37 +26,141 @@ Resize images
 
 Resize images to standard density
 
+Images are resized to fill the dimensions given by their real
+dimensions and the standard density, and written as PNG with
+their density metadata. By default, this is done in-process
+with PIL, decoding and encoding each image only once.
+ImageMagick can still be used, either as the backend, or as a
+fallback for images that PIL cannot read.
+
+Resized images are recorded in a manifest (.resize_manifest,
+next to them), with their source (its SHA1 digest in the CSV
+file, size and modification time) and the density and real
+dimensions they were resized with. Images are only resized
+again when any of these change.
+
+JPEG images are decoded at a reduced scale (1/2, 1/4 or 1/8),
+the smallest that still covers the resized dimensions, before
+they are resampled.
+
+Images with more pixels than a threshold are resized in
+strips, within a fixed memory budget, when their rows can be
+decoded separately (such as uncompressed TIFF). Otherwise,
+they are resized by ImageMagick, with its pixel cache on disk.
+
+Patches can also be extracted from the resized images, as
+patch_extraction.py does, while they are still in memory.
+Then, writing the resized images is optional.
+
+Images are resized in a pool of processes, limited by the
+estimated memory of each image (from its dimensions). Each
+image has a time limit, and failed images (including those
+lost with a crashed worker) are retried, and then reported
+(.resize_failures, next to the resized images), without
+stopping the others.
+
 """
 
 
 import sys
-import os.path
+import os
 import argparse
 import csv
-from math import ceil
-from subprocess import check_call, check_output, list2cmdline
-from multiprocessing import Pool
+import time
+import signal
+import traceback
+from math import ceil, floor
+from subprocess import Popen, PIPE, CalledProcessError, list2cmdline
+from functools import partial
+from multiprocessing import Pool, TimeoutError, cpu_count
+from multiprocessing.queues import SimpleQueue
+import numpy as np
+from PIL import Image
+from catalog import table_type, table_columns
+from probe_images import probe_image
 from common import set_verbose_level, get_verbose_level, print_verbose, \
-    dir_type, DEFAULT_DENSITY, \
+    dir_type, DEFAULT_DENSITY, WINDOW_SIZE, \
     VG_PREFIX, NVG_PREFIX, LABEL_SEPARATOR, VVG_ARTIST
 
 
+BACKEND_PIL = 'pil'
+BACKEND_IMAGEMAGICK = 'imagemagick'
+BACKENDS = [BACKEND_PIL, BACKEND_IMAGEMAGICK]
+
+RESIZE_MANIFEST_NAME = '.resize_manifest'
+
+# Modes that can be resized and written as PNG as they are
+PNG_MODES = ['L', 'LA', 'RGB', 'RGBA', 'I']
+
+# Color spaces of ICC profiles that still apply once converted to PNG
+#   As stored in the profile header (bytes 16 to 20)
+PNG_ICC_SPACES = ['RGB ', 'GRAY']
+
+# Images with more pixels are resized in strips
+DEFAULT_MAX_PIXELS = 64 * 1024 * 1024
+STRIP_MEMORY = 64 * 1024 * 1024         # bytes
+BYTES_PER_PIXEL = 8                     # ImageMagick (Q16, RGBA)
+
+# Pool of processes
+RESIZE_FAILURES_NAME = '.resize_failures'
+DEFAULT_TIMEOUT = 600                   # seconds
+DEFAULT_RETRIES = 1
+TIMEOUT_GRACE = 30                      # seconds
+POLL_INTERVAL = 1                       # seconds
+MAX_CHUNKSIZE = 16
+PROCESS_MEMORY = 64 * 1024 * 1024       # bytes, besides images
+
+# Support of the Lanczos filter
+LANCZOS_SUPPORT = 3.0
+
+# Raw modes whose rows can be decoded separately, by bytes per pixel
+RAW_ROW_BYTES = {'L': 1, 'P': 1, 'LA': 2, 'I;16': 2, 'I;16B': 2,
+        'RGB': 3, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4}
+
+# Large images are handled by max_pixels instead
+Image.MAX_IMAGE_PIXELS = None
+
+
 def parse_args(argv):
     parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.RawDescriptionHelpFormatter)
 
-    parser.add_argument('-c', '--csv', type=argparse.FileType('r'), required=True,
-            help='csv file')
+    parser.add_argument('-c', '--csv', type=table_type, required=True,
+            help='csv file or catalog')
     parser.add_argument('-o', '--original', type=dir_type, required=True,
             help='directory containing original images')
     parser.add_argument('-r', '--resized', type=dir_type, required=True,
             help='directory for resized images')
     parser.add_argument('-d', '--density', type=float, default=DEFAULT_DENSITY,
             help='standard density (default: %.2f)' % DEFAULT_DENSITY)
+    parser.add_argument('-b', '--backend', type=str, choices=BACKENDS, default=BACKEND_PIL,
+            help='resize backend (default: %s)' % BACKEND_PIL)
+    parser.add_argument('-p', '--patches', type=dir_type,
+            help='directory for patches of resized images')
+    parser.add_argument('-w', '--window', type=int, default=WINDOW_SIZE,
+            help='patch window size [NxN] (default: %d)' % WINDOW_SIZE)
+    parser.add_argument('-s', '--step', type=int, default=WINDOW_SIZE,
+            help='patch step size (default: %d)' % WINDOW_SIZE)
+    parser.add_argument('-n', '--no-resized', action='store_true',
+            help='do not write resized images, only their patches')
+    parser.add_argument('-m', '--max-pixels', type=int, default=DEFAULT_MAX_PIXELS,
+            help='resize larger images in strips, with bounded memory (default: %d)' % DEFAULT_MAX_PIXELS)
+    parser.add_argument('-j', '--cores', type=int, default=cpu_count(),
+            help='number of processes (default: %d)' % cpu_count())
+    parser.add_argument('-M', '--memory', type=int,
+            help='memory for all processes in MB, limiting their number (default: physical memory)')
+    parser.add_argument('-t', '--timeout', type=int, default=DEFAULT_TIMEOUT,
+            help='time limit for each image in seconds, 0 for none (default: %d)' % DEFAULT_TIMEOUT)
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+            help='number of retries of failed images (default: %d)' % DEFAULT_RETRIES)
+    parser.add_argument('-f', '--force', action='store_true',
+            help='resize all images, even those already resized')
     parser.add_argument('-v', '--verbose', action='count', default=0,
             help='verbosity level')
 
     args = parser.parse_args(args=argv)
+    if args.no_resized and args.patches is None:
+        parser.error('--no-resized requires --patches')
     return args
 
 # Parse paths from page entry
@@ -80,27 +184,210 @@ def parse_entry_sizes(density, realheight, realwidth):
     pixelwidth = int(ceil(density * realwidth))
     return pixelheight, pixelwidth
 
+# Dimensions that fill the final dimensions, keeping aspect ratio
+#   As the "%dx%d^" geometry of ImageMagick
+def fill_size(height, width, pixelheight, pixelwidth):
+    scale = max(1.0 * pixelheight / height, 1.0 * pixelwidth / width)
+    return max(1, int(scale * height + 0.5)), max(1, int(scale * width + 0.5))
+
+# Mode of image, to be written as PNG
+def png_mode(img):
+    if img.mode in PNG_MODES:
+        return img.mode
+    if 'A' in img.getbands() or 'transparency' in img.info:
+        return 'RGBA'
+    return 'RGB'
+
+# Raw tile split to the given rows, if it can be
+#   Rows of a raw tile are stored one after the other (top-down)
+def split_raw_tile(tile, width, y0, y1):
+    decoder, (x0, ty0, x1, ty1), offset, args = tile
+    if decoder != 'raw' or (x0, x1) != (0, width) or args[0] not in RAW_ROW_BYTES \
+            or len(args) < 3 or args[2] != 1:
+        return None
+
+    stride = args[1] or width * RAW_ROW_BYTES[args[0]]
+    y0, y1 = max(y0, ty0), min(y1, ty1)
+    return (decoder, (x0, y0, x1, y1), offset + (y0 - ty0) * stride, args)
+
+# Check whether the rows of an image can be decoded separately
+#   Either it has several strips (or tiles), or a single raw one
+def is_strippable(img):
+    return len(img.tile) > 1 or (len(img.tile) == 1 and
+            split_raw_tile(img.tile[0], img.size[0], 0, 1) is not None)
+
+# Decode rows of an image
+#   Only the strips (or tiles) covering the rows are decoded, and
+#   raw ones are split to the rows
+#   Returns the decoded rows, and the first of them
+def read_rows(orig_path, y0, y1):
+    img = Image.open(orig_path)
+
+    tiles = []
+    for tile in img.tile:
+        if tile[1][1] < y1 and tile[1][3] > y0:
+            tiles.append(split_raw_tile(tile, img.size[0], y0, y1) or tile)
+
+    first = min(tile[1][1] for tile in tiles)
+    last = max(tile[1][3] for tile in tiles)
+    img._size = (img.size[0], last - first)
+    img.tile = [(decoder, (x0, ty0 - first, x1, ty1 - first), offset, args)
+            for decoder, (x0, ty0, x1, ty1), offset, args in tiles]
+    img.load()
+
+    return img, first
+
+# Resize image in strips
+#   Each strip of the resized image is resampled from the source
+#   rows covering it (and the filter support), which are decoded
+#   within a memory budget
+def strip_resize(orig_path, img, height, width, memory=STRIP_MEMORY):
+    src_width, src_height = img.size
+    mode = png_mode(img)
+    scale = 1.0 * src_height / height
+    margin = int(ceil(LANCZOS_SUPPORT * max(scale, 1.0))) + 1
+    rows = max(1, int((memory / (4 * src_width) - 2 * margin) / scale))
+    print_verbose("Resizing %s in strips of %d rows" % (orig_path, rows), 3)
+
+    resized = Image.new(mode, (width, height))
+    for y0 in xrange(0, height, rows):
+        y1 = min(height, y0 + rows)
+        box_y0, box_y1 = y0 * scale, y1 * scale
+
+        strip, first = read_rows(orig_path, max(0, int(floor(box_y0)) - margin),
+                min(src_height, int(ceil(box_y1)) + margin))
+        if strip.mode != mode:
+            strip = strip.convert(mode)
+
+        resized.paste(strip.resize((width, y1 - y0), Image.LANCZOS,
+            box=(0, box_y0 - first, src_width, box_y1 - first)), (0, y0))
+        del strip
+
+    return resized
+
+# Resize image with PIL
+#   JPEG images are decoded at the smallest scale covering the
+#   resized dimensions (DCT scaling)
+#   Images with more than max_pixels are resized in strips, and
+#   those that cannot be are left to ImageMagick
+def pil_resize(orig_path, pixelheight, pixelwidth, max_pixels=DEFAULT_MAX_PIXELS):
+    img = Image.open(orig_path)
+    mode = img.mode
+    icc_profile = img.info.get('icc_profile')
+
+    height, width = fill_size(img.size[1], img.size[0], pixelheight, pixelwidth)
+    print_verbose("Resizing %s from %dx%d to %dx%d" % (orig_path,
+        img.size[0], img.size[1], width, height), 3)
+
+    if img.format == 'JPEG':
+        img.draft(img.mode, (width, height))
+        print_verbose("Decoding %s at %dx%d" % (orig_path, img.size[0], img.size[1]), 4)
+
+    if img.size[0] * img.size[1] > max_pixels:
+        if not is_strippable(img):
+            raise IOError("too large to be decoded at once")
+        img = strip_resize(orig_path, img, height, width)
+    else:
+        if img.mode not in PNG_MODES:
+            img = img.convert(png_mode(img))
+        img = img.resize((width, height), Image.LANCZOS)
+
+    # Profiles of other color spaces no longer apply once converted
+    img.info.pop('icc_profile', None)
+    if icc_profile and (img.mode == mode or icc_space(icc_profile) in PNG_ICC_SPACES):
+        img.info['icc_profile'] = icc_profile
+    return img
+
+# Color space of an ICC profile, from its header
+def icc_space(icc_profile):
+    return icc_profile[16:20]
+
+# Write resized image with density metadata
+#   The PNG density is stored in pixels per meter, as ImageMagick does
+def pil_save(img, dest_path, realheight, realwidth):
+    width, height = img.size
+    params = {'dpi': (width / realwidth, height / realheight)}
+    if img.info.get('icc_profile'):
+        params['icc_profile'] = img.info['icc_profile']
+    img.save(dest_path, 'PNG', **params)
+
+# Patches of an image, as in patch_extraction.py
+#   Windows of the image (as view_as_windows), centered by
+#   splitting the remaining borders
+def gen_patches(img, window_size, step_size):
+    im = np.asarray(img.convert('RGB'))
+
+    pos_x = ((im.shape[0] - window_size) % step_size) / 2
+    pos_y = ((im.shape[1] - window_size) % step_size) / 2
+    print_verbose("Position: %s" % str((pos_x, pos_y)), 5)
+
+    for x in xrange(pos_x, im.shape[0] - window_size + 1, step_size):
+        for y in xrange(pos_y, im.shape[1] - window_size + 1, step_size):
+            yield im[x:x+window_size, y:y+window_size, :]
+
+# Path of a patch, as in patch_extraction.py
+def gen_patch_path(im_path, patch_dir, id):
+    filename = os.path.splitext(os.path.basename(im_path))[0]
+    return os.path.join(patch_dir, "%s_%04d.png" % (filename, id))
+
+# Write patches of resized image
+def save_patches(img, dest_path, patch_dir, window_size, step_size):
+    id = 0
+    for patch in gen_patches(img, window_size, step_size):
+        patch_path = gen_patch_path(dest_path, patch_dir, id)
+        print_verbose("Saving patch %s ..." % patch_path, 3)
+        Image.fromarray(patch).save(patch_path, 'PNG')
+        id += 1
+    return id
+
+# Run command, and return its output if requested
+#   The command is killed if interrupted (e.g., by a timeout)
+def run_command(cmd, output=False):
+    proc = Popen(cmd, stdout=PIPE if output else None)
+    try:
+        out = proc.communicate()[0]
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            proc.wait()
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmd, out)
+    return out
+
 # Call convert (ImageMagick) to resize image
-def convert_resize(orig_path, dest_path, pixelheight, pixelwidth):
+#   JPEG images are decoded at a reduced scale, as with PIL
+#   Images with more than max_pixels are kept in a pixel cache on disk
+def convert_resize(orig_path, dest_path, pixelheight, pixelwidth,
+        max_pixels=DEFAULT_MAX_PIXELS):
     # Prepare command
-    cmd = ["convert", orig_path, "-resize",
+    memory = str(max_pixels * BYTES_PER_PIXEL)
+    cmd = ["convert", "-limit", "memory", memory, "-limit", "map", memory,
+                  "-define", "jpeg:size=%dx%d" % (pixelwidth, pixelheight),
+                  orig_path, "-resize",
                   "%dx%d^" % (pixelwidth, pixelheight), dest_path]
     if get_verbose_level() >= 5:
         cmd.insert(1, "-verbose")
 
     # Run
     print_verbose("Running command: " + list2cmdline(cmd), 3)
-    return check_call(cmd)
+    return run_command(cmd)
 
-# Call identify (ImageMagick) to get final dimensions in pixels
+# Get final dimensions in pixels
+#   Read from image headers, or with identify (ImageMagick)
+#   for other formats
 def identify_size(filepath):
+    fmt, h, w, quality = probe_image(filepath)
+    if h is not None and w is not None:
+        return h, w
+
     # Prepare command
     cmd = ["identify", "-format", "%h %w", filepath]
     if get_verbose_level() >= 6:
         cmd.insert(1, "-verbose")
 
     # Run
-    dims = str(check_output(cmd)).split()
+    dims = str(run_command(cmd, output=True)).split()
     h = int(dims[0])
     w = int(dims[1])
     return h, w
@@ -124,79 +411,364 @@ def convert_density(filepath, realheight, realwidth):
 
     # Run
     print_verbose("Running command: " + list2cmdline(cmd), 3)
-    return check_call(cmd)
-
-
-# Perform the resize operation
-def resize_image(page):
-
-    # Global params
-    global gb_idx_pageid
-    global gb_idx_img_url
-    global gb_idx_artist
-    global gb_idx_realheight
-    global gb_idx_realwidth
-    global gb_density
-    global gb_orig_dir
-    global gb_dest_dir
+    return run_command(cmd)
+
+# Manifest of resized images
+#   Each resized image is recorded with its source (SHA1 digest in the
+#   CSV file, size and modification time), the parameters it was resized with
+#   (density and real dimensions), and its own size and modification
+#   time, so it is only resized again when any of them change
+class ResizeManifest(object):
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        self.path = os.path.join(manifest_dir, RESIZE_MANIFEST_NAME)
+        self.entries = {}
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split(' ', 8)
+                    self.entries[fields[8]] = (fields[0], int(fields[1]), float(fields[2])) + \
+                            tuple(float(v) for v in fields[3:6]) + \
+                            (int(fields[6]), float(fields[7]))
+        print_verbose("Manifest %s: %d images" % (self.path, len(self.entries)), 1)
+
+    def key(self, dest_path):
+        return os.path.relpath(dest_path, self.manifest_dir)
+
+    # Source SHA1 digest (as in the CSV file), size and modification time
+    #   Sources are not hashed, as they were checked when downloaded,
+    #   and changes since then show in their size or modification time
+    def source(self, orig_path, img_sha1):
+        st = os.stat(orig_path)
+        return img_sha1, st.st_size, st.st_mtime
+
+    # Check whether the resized image is current, given its source
+    #   and parameters
+    def is_current(self, dest_path, source, params):
+        entry = self.entries.get(self.key(dest_path))
+        if entry is None or not os.path.isfile(dest_path):
+            return False
+        st = os.stat(dest_path)
+        return entry == source + params + (st.st_size, st.st_mtime)
+
+    def record(self, dest_path, source, params):
+        st = os.stat(dest_path)
+        self.entries[self.key(dest_path)] = source + params + (st.st_size, st.st_mtime)
+
+    def forget(self, dest_path):
+        self.entries.pop(self.key(dest_path), None)
+
+    # Save manifest atomically
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for rel_path, entry in sorted(self.entries.items()):
+                f.write("%s %d %r %r %r %r %d %r %s\n" % (entry + (rel_path,)))
+        os.rename(tmp_path, self.path)
+
+
+# Parse page entry
+#   Returns a task tuple (pageid, orig_path, dest_path, pixelheight,
+#   pixelwidth, realheight, realwidth)
+def parse_entry(indices, orig_dir, dest_dir, density, page):
+    idx_pageid, idx_img_url, idx_artist, idx_realheight, idx_realwidth = indices
 
     # Parse values
-    pageid = page[gb_idx_pageid]
-    img_url = page[gb_idx_img_url]
-    artist = page[gb_idx_artist]
-    realheight = float(page[gb_idx_realheight])
-    realwidth = float(page[gb_idx_realwidth])
+    pageid = page[idx_pageid]
+    img_url = page[idx_img_url]
+    artist = page[idx_artist]
+    realheight = float(page[idx_realheight])
+    realwidth = float(page[idx_realwidth])
 
     # Parse paths
-    orig_path, dest_path = parse_entry_paths(gb_orig_dir, gb_dest_dir, pageid, img_url, artist)
+    orig_path, dest_path = parse_entry_paths(orig_dir, dest_dir, pageid, img_url, artist)
 
     # Parse dimensions
-    pixelheight, pixelwidth = parse_entry_sizes(gb_density, realheight, realwidth)
+    pixelheight, pixelwidth = parse_entry_sizes(density, realheight, realwidth)
 
-    # Call convert to resize image
-    convert_resize(orig_path, dest_path, pixelheight, pixelwidth)
+    return pageid, orig_path, dest_path, pixelheight, pixelwidth, realheight, realwidth
 
-    # Call convert to update density metadata
-    convert_density(dest_path, realheight, realwidth)
 
-    print_verbose('Done processing pageid %s' % pageid, 0)
+# Perform the resize operation
+#   Options are a tuple (backend, patch_dir, window_size, step_size,
+#   no_resized, max_pixels)
+def resize_image(options, task):
+    backend, patch_dir, window_size, step_size, no_resized, max_pixels = options
+    pageid, orig_path, dest_path, pixelheight, pixelwidth, realheight, realwidth = task
+
+    # Resize image with PIL, falling back to ImageMagick
+    img = None
+    if backend == BACKEND_PIL:
+        try:
+            img = pil_resize(orig_path, pixelheight, pixelwidth, max_pixels)
+            if not no_resized:
+                pil_save(img, dest_path, realheight, realwidth)
+        except (IOError, ValueError) as e:
+            print_verbose("Could not resize %s with PIL (%s), using ImageMagick" % (orig_path, e), 0)
+            img = None
+
+    if img is None:
+        # Call convert to resize image
+        convert_resize(orig_path, dest_path, pixelheight, pixelwidth, max_pixels)
+
+        # Call convert to update density metadata
+        convert_density(dest_path, realheight, realwidth)
+
+        # Read back resized image for patches
+        if patch_dir is not None:
+            img = Image.open(dest_path)
+            img.load()
+            if no_resized:
+                os.remove(dest_path)
+
+    # Extract patches from resized image
+    if patch_dir is not None:
+        n_patches = save_patches(img, dest_path, patch_dir, window_size, step_size)
+        print_verbose('Saved %d patches of pageid %s' % (n_patches, pageid), 1)
+
+
+# Estimated memory to resize an image, in bytes
+#   From its dimensions in the headers, as decoded (JPEG images at
+#   reduced scale), up to max_pixels (larger ones use bounded memory)
+def estimate_memory(orig_path, pixelheight, pixelwidth, max_pixels):
+    fmt, height, width, quality = probe_image(orig_path)
+    if height is None:
+        pixels = max_pixels
+    else:
+        pixels = height * width
+        if fmt == 'JPEG':
+            scale = min(height / pixelheight, width / pixelwidth)
+            pixels /= max([1] + [s * s for s in (2, 4, 8) if scale >= s])
+        pixels = min(pixels, max_pixels)
+
+    return PROCESS_MEMORY + BYTES_PER_PIXEL * (pixels + pixelheight * pixelwidth)
+
+# Physical memory, in bytes
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class ResizeTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise ResizeTimeout("timed out")
+
+# Worker initialization
+#   Workers report the tasks they start, so that tasks lost with a
+#   worker (crashed, or hung past the timeout) can be told apart
+#   Reports are written right away (no feeder thread), so they are
+#   not lost if the worker crashes
+def init_worker(started):
+    global gb_started
+    gb_started = started
+    signal.signal(signal.SIGALRM, raise_timeout)
+
+# Run resize task, within a time limit (if any)
+#   Returns a tuple (key, error, seconds), where error is None on success
+def run_task(options, timeout, item):
+    key, task = item
+    gb_started.put((key, os.getpid(), time.time()))
+
+    start = time.time()
+    error = None
+    signal.alarm(timeout)
+    try:
+        resize_image(options, task)
+        signal.alarm(0)
+    except Exception as e:
+        signal.alarm(0)
+        error = "%s: %s" % (e.__class__.__name__, e)
+        print_verbose(traceback.format_exc(), 2)
+
+    return key, error, time.time() - start
+
+# Run a chunk of resize tasks, as run_task
+def run_chunk(options, timeout, chunk):
+    return [run_task(options, timeout, item) for item in chunk]
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+# Resize tasks in a pool of processes
+#   Tasks are given as (key, task) tuples, and results are yielded
+#   as they arrive, as returned by run_task. Failed tasks are retried,
+#   and so are tasks lost with a worker, in a new pool
+def run_pool(items, processes, options, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    pending = dict(items)
+    attempts = dict((key, 0) for key in pending)
+
+    while pending:
+        started = SimpleQueue()
+        pool = Pool(processes=processes, initializer=init_worker, initargs=(started,))
+        # Chunks are split here, as results of chunks split by the
+        #   pool could not be waited for with a timeout
+        chunksize = max(1, min(MAX_CHUNKSIZE, len(pending) / (4 * processes)))
+        items = pending.items()
+        chunks = [items[i:i+chunksize] for i in xrange(0, len(items), chunksize)]
+        results = pool.imap_unordered(partial(run_chunk, options, timeout), chunks)
+
+        running = {}
+        finished = set()
+        lost = []
+        try:
+            while not lost:
+                try:
+                    chunk = results.next(POLL_INTERVAL)
+                except StopIteration:
+                    break
+                except TimeoutError:
+                    # Check running tasks
+                    while not started.empty():
+                        key, pid, start = started.get()
+                        if key not in finished:
+                            running[key] = (pid, start)
+
+                    # Only the last task started by each worker is running,
+                    #   as the others of its chunk are done
+                    current = {}
+                    for key, (pid, start) in running.items():
+                        if pid not in current or start > current[pid][1]:
+                            current[pid] = (key, start)
+
+                    now = time.time()
+                    lost = [key for pid, (key, start) in current.items()
+                            if not is_alive(pid) or
+                            (timeout and now - start > timeout + TIMEOUT_GRACE)]
+                    continue
+
+                for key, error, seconds in chunk:
+                    finished.add(key)
+                    running.pop(key, None)
+                    attempts[key] += 1
+                    if error is None or attempts[key] > retries:
+                        del pending[key]
+                        yield key, error, seconds
+                    else:
+                        print_verbose("Retrying %s (%s)" % (pending[key][0], error), 0)
+
+        finally:
+            if lost:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+        # Tasks lost with a worker
+        for key in lost:
+            attempts[key] += 1
+            if attempts[key] > retries:
+                del pending[key]
+                yield key, "Lost worker (crashed or timed out)", None
+            else:
+                print_verbose("Retrying %s (lost worker)" % pending[key][0], 0)
+
+
+# Write report of failed images
+def write_failures(failures_path, failures):
+    with open(failures_path, 'wb') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, strict=True)
+        writer.writerow(['PageID', 'OriginalPath', 'Error'])
+        for task, error in failures:
+            writer.writerow([task[0], task[1], error])
 
 
 # Read CSV and resize images
-def resize_from_csv(csvfile, orig_dir, dest_dir, density):
-
-    # Global params
-    global gb_idx_pageid
-    global gb_idx_img_url
-    global gb_idx_artist
-    global gb_idx_realheight
-    global gb_idx_realwidth
-    global gb_density
-    global gb_orig_dir
-    global gb_dest_dir
-
-    # Define writer
-    reader = csv.reader(csvfile, quoting=csv.QUOTE_ALL, strict=True)
-
-    # Field names
-    field_names = reader.next()
+#   Images are resized in pools of processes, as many as cores, or
+#   fewer when their estimated memory would exceed the given memory
+def resize_from_csv(csvfile, orig_dir, dest_dir, density, backend=BACKEND_PIL,
+        force=False, patch_dir=None, window_size=WINDOW_SIZE, step_size=WINDOW_SIZE,
+        no_resized=False, max_pixels=DEFAULT_MAX_PIXELS, cores=cpu_count(),
+        memory=None, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+
+    # Read only the needed columns
+    field_names = ['PageID', 'ImageURL', 'Artist', 'RealHeightInches', 'RealWidthInches',
+            'ImageSHA1']
+    columns = table_columns(csvfile, field_names)
 
     # Indices
-    gb_idx_pageid = field_names.index('PageID')
-    gb_idx_img_url = field_names.index('ImageURL')
-    gb_idx_artist = field_names.index('Artist')
-    gb_idx_realheight = field_names.index('RealHeightInches')
-    gb_idx_realwidth = field_names.index('RealWidthInches')
-
-    # Prepare multicore execution
-    gb_orig_dir = orig_dir
-    gb_dest_dir = dest_dir
-    gb_density = density
-
-    pool = Pool()
-    pool.map(resize_image, reader)
-    pool.close()
-    pool.join()
+    indices = (field_names.index('PageID'),
+            field_names.index('ImageURL'),
+            field_names.index('Artist'),
+            field_names.index('RealHeightInches'),
+            field_names.index('RealWidthInches'))
+    idx_sha1 = field_names.index('ImageSHA1')
+
+    # Select images that are new or changed
+    #   When extracting patches, all images are processed
+    manifest = ResizeManifest(dest_dir)
+    tasks = []
+    entries = {}
+    failures = []
+    for page in zip(*columns):
+        task = parse_entry(indices, orig_dir, dest_dir, density, page)
+        pageid, orig_path, dest_path, pixelheight, pixelwidth, realheight, realwidth = task
+        if not os.path.isfile(orig_path):
+            failures.append((task, "Missing original image"))
+            continue
+
+        source = manifest.source(orig_path, page[idx_sha1])
+        params = (density, realheight, realwidth)
+        current = not force and manifest.is_current(dest_path, source, params)
+        if current and patch_dir is None:
+            print_verbose('Skipping pageid %s (already resized)' % pageid, 2)
+            continue
+
+        tasks.append(task)
+        entries[dest_path] = (source, params, current)
+
+    # Number of processes for each image, by estimated memory
+    if memory is None:
+        memory = physical_memory()
+    groups = {}
+    for key, task in enumerate(tasks):
+        estimate = estimate_memory(task[1], task[3], task[4], max_pixels)
+        processes = max(1, min(cores, memory / estimate))
+        groups.setdefault(processes, []).append((key, task))
+
+    print_verbose('Resizing %d images' % len(tasks), 0)
+
+    # Resize images, from the most concurrent to the least
+    #   Results are recorded as they arrive
+    options = (backend, patch_dir, window_size, step_size, no_resized, max_pixels)
+    count = 0
+    try:
+        for processes, items in sorted(groups.items(), reverse=True):
+            print_verbose('Resizing %d images with %d processes' % (len(items), processes), 1)
+            for key, error, seconds in run_pool(items, processes, options, timeout, retries):
+                count += 1
+                task = tasks[key]
+                if error is not None:
+                    failures.append((task, error))
+                    print_verbose('Failed processing pageid %s: %s' % (task[0], error), 0)
+                    continue
+
+                # Without resized images, a previous one is only kept if current
+                dest_path = task[2]
+                source, params, current = entries[dest_path]
+                if not no_resized:
+                    manifest.record(dest_path, source, params)
+                elif not current:
+                    manifest.forget(dest_path)
+                    if os.path.isfile(dest_path):
+                        os.remove(dest_path)
+                print_verbose('Done processing pageid %s in %.2f s [%d/%d]' % (task[0],
+                    seconds, count, len(tasks)), 0)
+    finally:
+        manifest.save()
+
+    # Report failures
+    failures_path = os.path.join(dest_dir, RESIZE_FAILURES_NAME)
+    if failures:
+        write_failures(failures_path, failures)
+        sys.stderr.write("Failed to resize %d images, see %s\n" % (len(failures), failures_path))
+    elif os.path.isfile(failures_path):
+        os.remove(failures_path)
 
     print_verbose('Completed!', 0)
 
@@ -212,7 +784,11 @@ def main(argv):
     print_verbose("Args: %s" % str(args), 1)
 
     # Resize images
-    resize_from_csv(args.csv, args.original, args.resized, args.density)
+    resize_from_csv(args.csv, args.original, args.resized, args.density,
+            args.backend, args.force, args.patches, args.window, args.step,
+            args.no_resized, args.max_pixels, args.cores,
+            args.memory * 2**20 if args.memory is not None else None,
+            args.timeout, args.retries)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+# scheduler.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Scheduler
+============================================================
+
+Adaptive, rate-limited scheduling of downloads
+
+Requests to each host are paced by a token bucket, which
+also holds requests while the host asks to (Retry-After).
+The number of concurrent downloads adapts to the servers:
+it is halved whenever they throttle (HTTP 429 or 503), and
+increased by one after a window of responses with healthy
+latency, as compared to the best latency seen so far.
+
+Metrics of each run (throughput, retries, throttling,
+concurrency and queue depth) are kept for reporting.
+
+"""
+
+
+import time
+import threading
+from contextlib import contextmanager
+from common import print_verbose, DEFAULT_THREADS
+
+
+# Throttling responses
+THROTTLE_STATUS = [429, 503]
+
+# Latency is healthy up to this factor of the best latency
+HEALTHY_LATENCY = 2.0
+
+# Smoothing factor of the latency average
+LATENCY_ALPHA = 0.2
+
+
+class TokenBucket(object):
+    def __init__(self, rate=0.0, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.resume = 0.0
+        self.lock = threading.Lock()
+
+    # Wait for a token (no limit if rate is zero)
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.resume:
+                    wait = self.resume - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.burst,
+                            self.tokens + (now - self.last) * self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Hold all requests for a given time
+    def pause(self, seconds):
+        with self.lock:
+            self.resume = max(self.resume, time.time() + seconds)
+
+
+class Scheduler(object):
+    def __init__(self, max_active=DEFAULT_THREADS, rate=0.0, burst=1):
+        self.max_active = max(1, max_active)
+        self.limit = max(1, self.max_active / 2)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.healthy = 0
+        self.latency = None
+        self.best_latency = None
+
+        # Metrics
+        self.start = time.time()
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttled = 0
+        self.max_waiting = 0
+        self.max_limit = self.limit
+
+    def bucket(self, host):
+        with self.cond:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    # Hold a download slot, within the concurrency limit
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.waiting -= 1
+            self.active += 1
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    # Wait before a request to a given host
+    def request(self, host):
+        self.bucket(host).acquire()
+
+    # Adapt to a response from a given host
+    def response(self, host, status, latency, retry_after=None):
+        with self.cond:
+            self.requests += 1
+
+            if status in THROTTLE_STATUS:
+                self.throttled += 1
+                self.healthy = 0
+                self.limit = max(1, self.limit / 2)
+                print_verbose("Throttled by %s (HTTP %d), concurrency %d" % (host,
+                    status, self.limit), 1)
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += LATENCY_ALPHA * (latency - self.latency)
+                self.best_latency = min(self.best_latency, self.latency) \
+                        if self.best_latency is not None else self.latency
+
+                if self.latency > HEALTHY_LATENCY * self.best_latency:
+                    self.healthy = 0
+                else:
+                    self.healthy += 1
+                    if self.healthy >= self.limit and self.limit < self.max_active:
+                        self.healthy = 0
+                        self.limit += 1
+                        self.max_limit = max(self.max_limit, self.limit)
+                        self.cond.notify_all()
+
+        if status in THROTTLE_STATUS and retry_after:
+            self.bucket(host).pause(retry_after)
+
+    def transferred(self, nbytes):
+        with self.cond:
+            self.bytes += nbytes
+
+    def retry(self):
+        with self.cond:
+            self.retries += 1
+
+    def metrics(self):
+        with self.cond:
+            elapsed = max(time.time() - self.start, 1e-6)
+            return {
+                    'elapsed'           : elapsed,
+                    'requests'          : self.requests,
+                    'bytes'             : self.bytes,
+                    'mb_per_s'          : self.bytes / elapsed / 2**20,
+                    'retries'           : self.retries,
+                    'throttled'         : self.throttled,
+                    'concurrency'       : self.limit,
+                    'max_concurrency'   : self.max_limit,
+                    'max_queue_depth'   : self.max_waiting,
+                    'latency'           : self.latency }
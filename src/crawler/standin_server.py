@@ -0,0 +1,446 @@
+#!/usr/bin/python
+
+# standin_server.py
+# Copyright 2016
+#   Guilherme Folego (gfolego@gmail.com)
+#   Otavio Gomes (otaviolmiro@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+"""
+============================================================
+Stand-in server
+============================================================
+
+Serve a local stand-in for the Commons API and image hosts
+
+API queries are answered with recorded responses from an
+API cache directory, when available, or synthesized
+otherwise. Synthetic pages use contents from the synthetic
+extraction corpus, and their images are synthetic payloads
+served by this same server. Latency, bandwidth and error
+rate are configurable. Failed API requests report
+replication lag (which clients retry), and failed image
+requests either return HTTP 503 or are interrupted halfway.
+Images support byte ranges, so interrupted downloads can be
+resumed, and are throttled (HTTP 429) beyond a number of
+concurrent transfers, if given.
+
+As the API does, queries return up to 500 pages per request,
+but page contents and extended metadata are only given for
+some of them, and continued (rvcontinue and iicontinue) in
+further requests for the same pages, alongside the generator
+continuation (gcmcontinue).
+
+Synthetic categories named 'Category:Synthetic_<first>_<count>'
+have pages <first> to <first>+<count>-1, so that overlapping
+categories can be crawled. Other categories have a default
+number of pages.
+
+The API is served at /w/api.php, images at /images/<pageid>.jpg
+and thumbnails at /thumb/<width>/<pageid>.jpg.
+
+"""
+
+
+import sys
+import os
+import argparse
+import json
+import time
+import random
+import hashlib
+import threading
+from zlib import crc32
+from urlparse import urlparse, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cache import ResponseCache, CacheMiss
+from crawl2csv import extract_image_fields
+from common import set_verbose_level, print_verbose, dir_type
+
+
+DEFAULT_PORT = 8080
+DEFAULT_PAGES = 500
+DEFAULT_IMAGE_SIZE = 1024 * 1024          # bytes
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'corpus', 'synthetic_wikitext.json')
+
+# Synthetic images
+IMAGE_HEIGHT = 4000
+IMAGE_WIDTH = 3000
+BLOCK_SIZE = 64 * 1024
+REVID_OFFSET = 1000000000
+
+# Maximum number of pages per request
+INFO_LIMIT = 500
+
+# Maximum number of pages per request with contents or extended metadata
+CONTENT_LIMIT = 50
+EXTMETADATA_LIMIT = 100
+
+SITEINFO = {
+        'general'           : {'generator': 'MediaWiki 1.28.0',
+                               'sitename': 'Stand-in', 'writeapi': ''},
+        'namespaces'        : {'0': {'id': 0, '*': ''},
+                               '6': {'id': 6, '*': 'File', 'canonical': 'File'},
+                               '14': {'id': 14, '*': 'Category', 'canonical': 'Category'}},
+        'namespacealiases'  : [],
+        'tokens'            : {} }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+            help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+            help='port to listen on (default: %d)' % DEFAULT_PORT)
+    parser.add_argument('-r', '--recorded', type=dir_type,
+            help='api cache directory with recorded responses')
+    parser.add_argument('-c', '--corpus', type=str, default=DEFAULT_CORPUS,
+            help='corpus of page contents (default: %s)' % DEFAULT_CORPUS)
+    parser.add_argument('-n', '--pages', type=int, default=DEFAULT_PAGES,
+            help='number of pages of synthetic categories (default: %d)' % DEFAULT_PAGES)
+    parser.add_argument('-s', '--image-size', type=int, default=DEFAULT_IMAGE_SIZE,
+            help='size of synthetic images in bytes (default: %d)' % DEFAULT_IMAGE_SIZE)
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+            help='latency of each request in seconds (default: 0)')
+    parser.add_argument('-b', '--bandwidth', type=float, default=0.0,
+            help='bandwidth of each connection in bytes/s (default: unlimited)')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+            help='fraction of requests that fail (default: 0)')
+    parser.add_argument('-m', '--max-active', type=int, default=0,
+            help='throttle image requests beyond this many at once (default: unlimited)')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+            help='verbosity level')
+
+    args = parser.parse_args(args=argv)
+    return args
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, corpus=DEFAULT_CORPUS, recorded=None,
+            pages=DEFAULT_PAGES, image_size=DEFAULT_IMAGE_SIZE,
+            latency=0.0, bandwidth=0.0, error_rate=0.0, max_active=0):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.base_url = 'http://%s:%d' % self.server_address
+        self.pages = pages
+        self.image_size = image_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.max_active = max_active
+        self.active = 0
+        self.sha1s = {}
+        self.lock = threading.Lock()
+
+        with open(corpus, 'r') as f:
+            self.corpus = [page['content'] for page in json.load(f)]
+
+        self.recorded = None
+        if recorded is not None:
+            self.recorded = ResponseCache(recorded, offline=True)
+
+    # Synthetic image payload, as blocks
+    def image_blocks(self, page_id, size, offset=0):
+        block = hashlib.sha1(str(page_id)).digest() * (BLOCK_SIZE / 20 + 1)
+        block = block[:BLOCK_SIZE]
+        while offset < size:
+            start = offset % BLOCK_SIZE
+            end = min(BLOCK_SIZE, start + size - offset)
+            yield block[start:end]
+            offset += end - start
+
+    def image_sha1(self, page_id):
+        with self.lock:
+            if page_id not in self.sha1s:
+                sha1 = hashlib.sha1()
+                for block in self.image_blocks(page_id, self.image_size):
+                    sha1.update(block)
+                self.sha1s[page_id] = sha1.hexdigest()
+            return self.sha1s[page_id]
+
+    def thumb_size(self, width):
+        return max(1, int(self.image_size * (1.0 * width / IMAGE_WIDTH) ** 2))
+
+    # Page IDs of a synthetic category
+    def category_ids(self, title):
+        parts = title.split(':', 1)[-1].split('_')
+        if len(parts) == 3 and parts[0] == 'Synthetic':
+            first, count = int(parts[1]), int(parts[2])
+        else:
+            first, count = (crc32(title) & 0xffff) * 100000 + 1, self.pages
+        return range(first, first + count)
+
+    def gen_page(self, page_id, params):
+        props = params.get('prop', '').split('|')
+        content = self.corpus[page_id % len(self.corpus)]
+        page = {'pageid': page_id, 'ns': 6, 'title': 'File:Synthetic %d.jpg' % page_id}
+
+        if 'info' in props:
+            page['lastrevid'] = REVID_OFFSET + page_id
+
+        if 'imageinfo' in props:
+            iiprop = params.get('iiprop', '').split('|')
+            info = {}
+            if 'url' in iiprop:
+                info['url'] = '%s/images/%d.jpg' % (self.base_url, page_id)
+                info['descriptionurl'] = '%s/wiki/File:Synthetic_%d.jpg' % (self.base_url, page_id)
+            if 'sha1' in iiprop:
+                info['sha1'] = self.image_sha1(page_id)
+            if 'size' in iiprop:
+                info['height'] = IMAGE_HEIGHT
+                info['width'] = IMAGE_WIDTH
+                info['size'] = self.image_size
+            if 'extmetadata' in iiprop:
+                artist = extract_image_fields(content).get('artist')
+                info['extmetadata'] = {}
+                if artist:
+                    info['extmetadata']['Artist'] = {'value': '<bdi>%s</bdi>' % artist}
+            if 'iiurlwidth' in params:
+                width = min(int(params['iiurlwidth']), IMAGE_WIDTH)
+                info['thumburl'] = '%s/thumb/%d/%d.jpg' % (self.base_url, width, page_id)
+                info['thumbwidth'] = width
+                info['thumbheight'] = IMAGE_HEIGHT * width / IMAGE_WIDTH
+            page['imageinfo'] = [info]
+
+        if 'revisions' in props:
+            rev = {'revid': REVID_OFFSET + page_id}
+            if 'content' in params.get('rvprop', ''):
+                rev['*'] = content
+            page['revisions'] = [rev]
+
+        return page
+
+    # Page limits of props, with their continuation parameters
+    def prop_limits(self, params):
+        limits = {}
+        if 'content' in params.get('rvprop', ''):
+            limits['revisions'] = ('rvcontinue', CONTENT_LIMIT)
+        if 'extmetadata' in params.get('iiprop', ''):
+            limits['imageinfo'] = ('iicontinue', EXTMETADATA_LIMIT)
+        return limits
+
+    # Answer an API query
+    def api_query(self, params):
+        params = dict((k, v) for k, v in params.items() if k not in ['format', 'maxlag'])
+
+        if 'meta' in params:
+            return {'query': SITEINFO}
+
+        if self.recorded is not None:
+            try:
+                return self.recorded.get(params)
+            except CacheMiss:
+                pass
+
+        limit = INFO_LIMIT
+        result = {'query': {'pages': {}}}
+
+        if params.get('generator') == 'categorymembers':
+            ids = self.category_ids(params['gcmtitle'])
+            if params.get('gcmlimit', 'max') != 'max':
+                limit = min(limit, int(params['gcmlimit']))
+            start = int(params.get('gcmcontinue', 0))
+            if start + limit < len(ids):
+                result['query-continue'] = {'categorymembers':
+                        {'gcmcontinue': str(start + limit)}}
+            ids = ids[start:start + limit]
+        elif 'pageids' in params:
+            ids = [int(i) for i in params['pageids'].split('|')]
+        elif 'revids' in params:
+            ids = [int(i) - REVID_OFFSET for i in params['revids'].split('|')]
+        elif 'titles' in params:
+            ids = [(crc32(title) & 0xffff) * 100000 for title in params['titles'].split('|')]
+        else:
+            return {'error': {'code': 'badparams', 'info': 'Unsupported query'}}
+
+        # Range of pages given each prop
+        #   Continuations only give the props being continued
+        limits = self.prop_limits(params)
+        continuing = any(param in params for param, prop_limit in limits.values())
+        props = [prop for prop in params.get('prop', '').split('|') if prop]
+        ranges = {}
+        for prop in props:
+            if prop in limits:
+                param, prop_limit = limits[prop]
+                if continuing and param not in params:
+                    ranges[prop] = (0, 0)
+                    continue
+                start = int(params.get(param, 0))
+                ranges[prop] = (start, start + prop_limit)
+                if start + prop_limit < len(ids):
+                    result.setdefault('query-continue', {})[prop] = {param: str(start + prop_limit)}
+            else:
+                ranges[prop] = (0, 0 if continuing else len(ids))
+
+        for idx, page_id in enumerate(ids):
+            page_props = [prop for prop in props if ranges[prop][0] <= idx < ranges[prop][1]]
+            result['query']['pages'][str(page_id)] = self.gen_page(page_id,
+                    dict(params, prop='|'.join(page_props)))
+
+        return result
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        print_verbose("%s - %s" % (self.address_string(), format % args), 3)
+
+    # Send response
+    #   If truncate is given, the connection is closed after
+    #   sending that many bytes of the body
+    def send_body(self, code, content_type, blocks, length, headers={}, truncate=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        if self.command == 'HEAD':
+            return
+
+        sent = 0
+        for block in blocks:
+            if truncate is not None and sent + len(block) > truncate:
+                self.wfile.write(block[:truncate - sent])
+                self.close_connection = True
+                return
+
+            self.wfile.write(block)
+            sent += len(block)
+            if self.server.bandwidth > 0:
+                time.sleep(len(block) / self.server.bandwidth)
+
+    def send_json(self, result):
+        body = json.dumps(result)
+        self.send_body(200, 'application/json; charset=utf-8', [body], len(body))
+
+    def handle_request(self, params):
+        server = self.server
+        path = urlparse(self.path).path.strip('/').split('/')
+
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        failed = random.random() < server.error_rate
+
+        # API
+        if path == ['w', 'api.php']:
+            if failed:
+                return self.send_json({'error': {'code': 'maxlag',
+                    'info': 'Waiting for stand-in: 0 seconds lagged'}})
+            return self.send_json(server.api_query(params))
+
+        # Images
+        try:
+            if len(path) == 2 and path[0] == 'images':
+                page_id = int(os.path.splitext(path[1])[0])
+                size = server.image_size
+            elif len(path) == 3 and path[0] == 'thumb':
+                page_id = int(os.path.splitext(path[2])[0])
+                size = server.thumb_size(int(path[1]))
+            else:
+                raise ValueError(self.path)
+        except ValueError:
+            body = 'Not found'
+            return self.send_body(404, 'text/plain', [body], len(body))
+
+        # Byte range, from a given offset only
+        offset = 0
+        code = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        byte_range = self.headers.getheader('Range', '')
+        if byte_range.startswith('bytes=') and byte_range.endswith('-'):
+            offset = int(byte_range[len('bytes='):-1])
+            if offset >= size:
+                body = 'Range not satisfiable'
+                return self.send_body(416, 'text/plain', [body], len(body),
+                        {'Content-Range': 'bytes */%d' % size})
+            code = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, size - 1, size)
+
+        # Throttle when too many images are being transferred
+        with server.lock:
+            throttled = server.max_active > 0 and server.active >= server.max_active
+            if not throttled:
+                server.active += 1
+        if throttled:
+            body = 'Too many requests'
+            return self.send_body(429, 'text/plain', [body], len(body),
+                    {'Retry-After': '1'})
+
+        try:
+            self.send_image(page_id, size, offset, code, headers, failed)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def send_image(self, page_id, size, offset, code, headers, failed):
+        server = self.server
+
+        # Failures are either errors or interrupted transfers
+        truncate = None
+        if failed:
+            if random.random() < 0.5:
+                body = 'Service unavailable'
+                return self.send_body(503, 'text/plain', [body], len(body))
+            truncate = (size - offset) / 2
+
+        self.send_body(code, 'image/jpeg', server.image_blocks(page_id, size, offset),
+                size - offset, headers, truncate)
+
+    def do_GET(self):
+        self.handle_request(dict(parse_qsl(urlparse(self.path).query, True)))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length', 0))
+        params = dict(parse_qsl(urlparse(self.path).query, True))
+        params.update(parse_qsl(self.rfile.read(length), True))
+        self.handle_request(params)
+
+
+# Main
+def main(argv):
+
+    # Parse arguments
+    args = parse_args(argv)
+    set_verbose_level(args.verbose)
+
+    print_verbose("Args: %s" % str(args), 1)
+
+    # Serve
+    server = StandinServer((args.host, args.port), args.corpus, args.recorded,
+            args.pages, args.image_size, args.latency, args.bandwidth,
+            args.error_rate, args.max_active)
+    print_verbose("Serving at %s/w/api.php" % server.base_url, 0)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])